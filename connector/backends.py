@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from pymongo import MongoClient, MongoReplicaSetClient
+from pymongo.uri_parser import parse_uri
+
+from connector.memory import MemoryClient
+
+
+class PymongoBackend(object):
+    """
+    Connects to the MongoDB deployment at MONGO_URI.  A replica set, named
+    by the replicaSet option of the URI or by MONGO_REPLICA_SET, gets a
+    MongoReplicaSetClient, the client that honours read preferences; a
+    plain MongoClient only does so through mongos.
+    """
+
+    @staticmethod
+    def client_class(uri, **options):
+        if options.get('replicaSet') or \
+                uri and parse_uri(uri)['options'].get('replicaset'):
+            return MongoReplicaSetClient
+        return MongoClient
+
+    def create_client(self, uri, **options):
+        return self.client_class(uri, **options)(uri, **options)
+
+
+class MemoryBackend(object):
+    """
+    Keeps every database in this process, so the model layer can be tested,
+    benchmarked and profiled without a server.  Clients share one store, so
+    data survives reconnects as it would on a server.
+    """
+
+    def __init__(self):
+        self.store = dict()
+
+    def create_client(self, uri, **options):
+        return MemoryClient(self.store)
+
+
+BACKENDS = {
+    'pymongo': 'connector.backends.PymongoBackend',
+    'memory': 'connector.backends.MemoryBackend',
+}
+
+_backends = dict()
+
+
+def get_backend():
+    """
+    The backend named by the MONGO_BACKEND setting: 'pymongo' (the
+    default), 'memory', or the dotted path of a class with a
+    create_client(uri, **options) method returning a MongoClient-like object
+    """
+    name = getattr(settings, 'MONGO_BACKEND', 'pymongo')
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backends[name] = import_string(BACKENDS.get(name, name))()
+    return backend
@@ -0,0 +1,365 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from bson import BSON
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SLOW_LOG_SIZE = 100
+
+# keys whose list values are sets of query values, not sub-queries
+_LIST_OPERATORS = ('$and', '$or', '$nor')
+
+
+def query_shape(query):
+    """
+    The query with its values replaced by '?', so queries differing only in
+    their values have the same shape
+    """
+    if not isinstance(query, dict):
+        return '?'
+    shape = dict()
+    for key, value in query.items():
+        if key in _LIST_OPERATORS and isinstance(value, list):
+            shape[key] = [query_shape(sub_query) for sub_query in value]
+        elif isinstance(value, dict) and \
+                any(k.startswith('$') for k in value):
+            shape[key] = query_shape(value)
+        else:
+            shape[key] = '?'
+    return shape
+
+
+def pipeline_shape(pipeline):
+    """
+    The shape of an aggregation pipeline: its stage names, with the queries
+    of $match stages reduced to their shapes
+    """
+    shape = list()
+    for stage in pipeline:
+        for name, spec in stage.items():
+            if name == '$match':
+                shape.append({name: query_shape(spec)})
+            else:
+                shape.append(name)
+    return shape
+
+
+class _Timer(object):
+    def __init__(self, operation, phase):
+        self.operation = operation
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.start
+        if self.phase == 'server':
+            self.operation.server_time += elapsed
+        else:
+            self.operation.processing_time += elapsed
+
+
+class Operation(object):
+    """
+    The timings of one model or connector operation, handed to every sink
+    once it completes:
+
+        with instrument(Model, 'find', query) as operation:
+            with operation.server():
+                documents = list(cursor)
+            with operation.processing():
+                models = hydrate(documents)
+            operation.add_documents(documents)
+
+    server_time covers the round trips to the server, processing_time the
+    hydration or serialization of documents in this process.  For streaming
+    operations total_time is their sum, leaving out the caller's own time
+    between batches.
+    """
+
+    def __init__(self, model, operation, query=None, streaming=False):
+        if isinstance(model, type):
+            model = model.__name__
+        elif model is not None and not isinstance(model, str):
+            model = model.__class__.__name__
+        self.model = model
+        self.operation = operation
+        self.query = query
+        self.server_time = 0.0
+        self.processing_time = 0.0
+        self.total_time = 0.0
+        self.documents = 0
+        self.size = 0
+        self.error = None
+        self.streaming = streaming
+        self._measure_sizes = getattr(
+            settings, 'MONGO_INSTRUMENT_DOCUMENT_SIZES', False)
+
+    def server(self):
+        return _Timer(self, 'server')
+
+    def processing(self):
+        return _Timer(self, 'processing')
+
+    def add_documents(self, documents):
+        for document in documents:
+            if document is None:
+                continue
+            self.documents += 1
+            if self._measure_sizes:
+                self.size += len(BSON.encode(document))
+
+    @property
+    def shape(self):
+        if self.query is None:
+            return None
+        if isinstance(self.query, list):
+            return json.dumps(pipeline_shape(self.query), sort_keys=True)
+        return json.dumps(query_shape(self.query), sort_keys=True)
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.streaming:
+            # leave out the time the caller spent between batches
+            self.total_time = self.server_time + self.processing_time
+        else:
+            self.total_time = time.time() - self._start
+        if exc_value is not None and \
+                not isinstance(exc_value, GeneratorExit):
+            self.error = '{}: {}'.format(exc_type.__name__, exc_value)
+        for sink in get_sinks():
+            try:
+                sink.record(self)
+            except Exception as e:
+                log.exception('Instrumentation sink {} failed: {}'.
+                              format(sink, e))
+
+    def __repr__(self):
+        return '<Operation {}.{}: {:.2f} ms>'.format(
+            self.model, self.operation, self.total_time * 1000)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _NullOperation(object):
+    """
+    Stands in for Operation while no sink is configured, so instrumented
+    code paths cost next to nothing
+    """
+    _timer = _NullTimer()
+
+    def server(self):
+        return self._timer
+
+    def processing(self):
+        return self._timer
+
+    def add_documents(self, documents):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_operation = _NullOperation()
+
+
+def instrument(model, operation, query=None, streaming=False):
+    """
+    :param model: the model class or instance, or None for connector
+        operations
+    :param operation: the operation name, e.g. 'find' or 'save'
+    :param query: the query or aggregation pipeline of the operation,
+        logged by its shape
+    :param streaming: whether the operation yields results to its caller
+    :return: a context manager timing the operation
+    """
+    if not get_sinks():
+        return _null_operation
+    return Operation(model, operation, query, streaming)
+
+
+class LoggingSink(object):
+    """
+    Logs every operation at DEBUG level
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or log
+        self.level = level
+
+    def record(self, operation):
+        self.logger.log(
+            self.level, '{}.{}: {:.2f} ms (server {:.2f} ms, processing '
+            '{:.2f} ms), {} documents, {} bytes, shape {}{}'.format(
+                operation.model, operation.operation,
+                operation.total_time * 1000, operation.server_time * 1000,
+                operation.processing_time * 1000, operation.documents,
+                operation.size, operation.shape,
+                ', error {}'.format(operation.error)
+                if operation.error else ''))
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class HistogramSink(object):
+    """
+    A Prometheus-style registry of per model and operation histograms of
+    the total, server and processing times, plus counters of documents,
+    bytes and errors.  render() returns the text exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='mongo'):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.histograms = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def record(self, operation):
+        labels = (('model', operation.model or ''),
+                  ('operation', operation.operation))
+        with self._lock:
+            for phase, value in (('total', operation.total_time),
+                                 ('server', operation.server_time),
+                                 ('processing', operation.processing_time)):
+                key = ('operation_seconds', labels + (('phase', phase),))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = \
+                        Histogram(self.buckets)
+                histogram.observe(value)
+            for name, value in (('documents_total', operation.documents),
+                                ('bytes_total', operation.size),
+                                ('errors_total', int(bool(operation.error)))):
+                key = (name, labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        return '{' + ','.join('{}="{}"'.format(name, value)
+                              for name, value in labels + extra) + '}'
+
+    def render(self):
+        lines = list()
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = '{}_{}'.format(self.prefix, name)
+                cumulative = 0
+                for bucket, count in zip(self.buckets + ('+Inf',),
+                                         histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, self._labels(labels, (('le', bucket),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, self._labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(
+                    name, self._labels(labels), histogram.count))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}_{}{} {}'.format(
+                    self.prefix, name, self._labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class SlowOperationLog(object):
+    """
+    Logs a warning with the normalized query shape for every operation
+    taking at least threshold_ms, and keeps the most recent ones in entries
+    """
+
+    def __init__(self, threshold_ms, size=SLOW_LOG_SIZE, logger=None):
+        self.threshold = threshold_ms / 1000.0
+        self.entries = deque(maxlen=size)
+        self.logger = logger or log
+
+    def record(self, operation):
+        if operation.total_time < self.threshold:
+            return
+        entry = {'model': operation.model,
+                 'operation': operation.operation,
+                 'shape': operation.shape,
+                 'total_ms': operation.total_time * 1000,
+                 'server_ms': operation.server_time * 1000,
+                 'processing_ms': operation.processing_time * 1000,
+                 'documents': operation.documents,
+                 'bytes': operation.size,
+                 'error': operation.error}
+        self.entries.append(entry)
+        self.logger.warning('Slow operation {model}.{operation}: '
+                            '{total_ms:.2f} ms (server {server_ms:.2f} ms), '
+                            '{documents} documents, shape {shape}'.
+                            format(**entry))
+
+
+_sinks = None
+_lock = threading.Lock()
+
+
+def get_sinks():
+    """
+    The configured sinks: the instances or dotted class paths listed in
+    MONGO_INSTRUMENTATION, plus a SlowOperationLog when
+    MONGO_SLOW_OPERATION_MS is set
+    """
+    global _sinks
+    if _sinks is None:
+        with _lock:
+            if _sinks is None:
+                sinks = list()
+                for sink in getattr(settings, 'MONGO_INSTRUMENTATION', ()):
+                    if isinstance(sink, str):
+                        sink = import_string(sink)()
+                    sinks.append(sink)
+                threshold = getattr(settings, 'MONGO_SLOW_OPERATION_MS',
+                                    None)
+                if threshold is not None:
+                    sinks.append(SlowOperationLog(threshold))
+                _sinks = sinks
+    return _sinks
+
+
+def add_sink(sink):
+    get_sinks()
+    with _lock:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    with _lock:
+        if _sinks and sink in _sinks:
+            _sinks.remove(sink)
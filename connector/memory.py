@@ -0,0 +1,1134 @@
+import copy
+import numbers
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import reduce
+from operator import add, mul, sub, truediv
+
+from bson import BSON
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    InvalidOperation, OperationFailure
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+_pattern_type = type(re.compile(''))
+
+# the order of BSON types when values of different types are compared
+_TYPE_ORDER = (
+    (type(None), 1),
+    (bool, 8),
+    (int, 2),
+    (float, 2),
+    (string_types, 3),
+    (dict, 4),
+    (list, 5),
+    (ObjectId, 7),
+    (datetime, 9),
+)
+
+_MISSING = object()
+
+# the arithmetic expression operators supported in aggregation pipelines
+_ARITHMETIC = {
+    '$add': add,
+    '$subtract': sub,
+    '$multiply': mul,
+    '$divide': truediv,
+}
+
+
+def _type_rank(value):
+    for _type, rank in _TYPE_ORDER:
+        if isinstance(value, _type):
+            return rank
+    try:
+        if isinstance(value, long):
+            return 2
+    except NameError:
+        pass
+    return 10
+
+
+def _sort_value(value):
+    rank = _type_rank(value)
+    if rank == 4:
+        return rank, sorted((k, _sort_value(v)) for k, v in value.items())
+    if rank == 5:
+        return rank, [_sort_value(v) for v in value]
+    return rank, value
+
+
+def _copy(document):
+    """
+    Round trip a document through BSON, as the driver and server would:
+    documents are validated and callers never share state with the store
+    """
+    return BSON.encode(document).decode()
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _is_operator_dict(condition):
+    return isinstance(condition, dict) and condition and \
+        all(key.startswith('$') for key in condition)
+
+
+def _lookup(value, parts):
+    """
+    The values found at a dotted path, descending into the elements of
+    arrays like the server does; empty if the path is missing
+    """
+    if not parts:
+        return [value]
+    part = parts[0]
+    if isinstance(value, dict):
+        if part in value:
+            return _lookup(value[part], parts[1:])
+        return []
+    if isinstance(value, list):
+        results = list()
+        if part.isdigit() and int(part) < len(value):
+            results.extend(_lookup(value[int(part)], parts[1:]))
+        for item in value:
+            if isinstance(item, dict):
+                results.extend(_lookup(item, parts))
+        return results
+    return []
+
+
+def _expand(values):
+    """
+    The candidate values of a path: the values and the elements of those
+    that are arrays
+    """
+    candidates = list()
+    for value in values:
+        candidates.append(value)
+        if isinstance(value, list):
+            candidates.extend(value)
+    return candidates
+
+
+def _equals(values, expected):
+    if isinstance(expected, _pattern_type):
+        return any(isinstance(value, string_types) and expected.search(value)
+                   for value in _expand(values))
+    if not values:
+        return expected is None
+    return any(value == expected for value in _expand(values))
+
+
+def _compare(values, expected, test):
+    rank = _type_rank(expected)
+    return any(_type_rank(value) == rank and test(value, expected)
+               for value in _expand(values))
+
+
+def _regex(pattern, options=''):
+    flags = 0
+    for option, flag in (('i', re.I), ('m', re.M), ('s', re.S),
+                         ('x', re.X)):
+        if option in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _match_operators(values, conditions):
+    for operator, argument in conditions.items():
+        if operator == '$eq':
+            matched = _equals(values, argument)
+        elif operator == '$ne':
+            matched = not _equals(values, argument)
+        elif operator == '$in':
+            matched = any(_equals(values, item) for item in argument)
+        elif operator == '$nin':
+            matched = not any(_equals(values, item) for item in argument)
+        elif operator == '$gt':
+            matched = _compare(values, argument, lambda a, b: a > b)
+        elif operator == '$gte':
+            matched = _compare(values, argument, lambda a, b: a >= b)
+        elif operator == '$lt':
+            matched = _compare(values, argument, lambda a, b: a < b)
+        elif operator == '$lte':
+            matched = _compare(values, argument, lambda a, b: a <= b)
+        elif operator == '$exists':
+            matched = bool(values) == bool(argument)
+        elif operator == '$regex':
+            if not isinstance(argument, _pattern_type):
+                argument = _regex(argument, conditions.get('$options', ''))
+            matched = _equals(values, argument)
+        elif operator == '$options':
+            matched = True
+        elif operator == '$size':
+            matched = any(isinstance(value, list) and
+                          len(value) == argument for value in values)
+        elif operator == '$all':
+            matched = all(_equals(values, item) for item in argument)
+        elif operator == '$elemMatch':
+            matched = any(_match_element(item, argument)
+                          for value in values if isinstance(value, list)
+                          for item in value)
+        elif operator == '$not':
+            if isinstance(argument, _pattern_type):
+                matched = not _equals(values, argument)
+            else:
+                matched = not _match_operators(values, argument)
+        elif operator == '$mod':
+            divisor, remainder = argument
+            matched = _compare(values, 0,
+                               lambda a, b: a % divisor == remainder)
+        else:
+            raise OperationFailure('unknown operator: {}'.format(operator))
+        if not matched:
+            return False
+    return True
+
+
+def _match_element(item, condition):
+    if _is_operator_dict(condition):
+        return _match_operators([item], condition)
+    return isinstance(item, dict) and match(item, condition)
+
+
+def match(document, query):
+    """
+    :return: whether a document matches a query
+    """
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            matched = all(match(document, sub) for sub in condition)
+        elif key == '$or':
+            matched = any(match(document, sub) for sub in condition)
+        elif key == '$nor':
+            matched = not any(match(document, sub) for sub in condition)
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: {}'.
+                                   format(key))
+        else:
+            values = _lookup(document, key.split('.'))
+            if _is_operator_dict(condition):
+                matched = _match_operators(values, condition)
+            else:
+                matched = _equals(values, condition)
+        if not matched:
+            return False
+    return True
+
+
+def _project(document, fields):
+    """
+    Apply a find() projection, given as a list of field names or as a dict
+    of field names to 1 (include) or 0 (exclude)
+    """
+    if fields is None:
+        return document
+    if not isinstance(fields, dict):
+        fields = dict((field, 1) for field in fields)
+    include_id = fields.get('_id', 1)
+    fields = dict((k, v) for k, v in fields.items() if k != '_id')
+    if any(fields.values()):
+        projected = dict()
+        for field in fields:
+            _copy_path(document, projected, field.split('.'))
+    else:
+        projected = copy.deepcopy(document)
+        for field in fields:
+            _unset(projected, field.split('.'))
+    if include_id and '_id' in document:
+        projected['_id'] = document['_id']
+    else:
+        projected.pop('_id', None)
+    return projected
+
+
+def _copy_path(source, target, parts):
+    part = parts[0]
+    if part not in source:
+        return
+    value = source[part]
+    if len(parts) == 1:
+        target[part] = copy.deepcopy(value)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(part, dict()), parts[1:])
+    elif isinstance(value, list):
+        items = target.setdefault(part, list())
+        for item in value:
+            if isinstance(item, dict):
+                projected = dict()
+                _copy_path(item, projected, parts[1:])
+                items.append(projected)
+
+
+def _container(document, parts, create):
+    """
+    The dict or list holding the last part of a dotted path
+    """
+    container = document
+    for part in parts[:-1]:
+        if isinstance(container, list):
+            index = int(part)
+            while create and len(container) <= index:
+                container.append(None)
+            if index >= len(container):
+                return None
+            if container[index] is None and create:
+                container[index] = dict()
+            container = container[index]
+        elif isinstance(container, dict):
+            if part not in container:
+                if not create:
+                    return None
+                container[part] = dict()
+            container = container[part]
+        else:
+            if create:
+                raise OperationFailure('cannot create field {} in {}'.
+                                       format(part, container))
+            return None
+    return container
+
+
+def _get(document, parts):
+    container = _container(document, parts, False)
+    if isinstance(container, dict):
+        return container.get(parts[-1], _MISSING)
+    if isinstance(container, list) and parts[-1].isdigit() and \
+            int(parts[-1]) < len(container):
+        return container[int(parts[-1])]
+    return _MISSING
+
+
+def _set(document, parts, value):
+    container = _container(document, parts, True)
+    if isinstance(container, list):
+        index = int(parts[-1])
+        while len(container) <= index:
+            container.append(None)
+        container[index] = value
+    else:
+        container[parts[-1]] = value
+
+
+def _unset(document, parts):
+    container = _container(document, parts, False)
+    if isinstance(container, dict):
+        container.pop(parts[-1], None)
+    elif isinstance(container, list) and parts[-1].isdigit() and \
+            int(parts[-1]) < len(container):
+        container[int(parts[-1])] = None
+
+
+def _array(document, parts, operator):
+    value = _get(document, parts)
+    if value is _MISSING:
+        value = list()
+        _set(document, parts, value)
+    elif not isinstance(value, list):
+        raise OperationFailure('{} requires an array at {}'.
+                               format(operator, '.'.join(parts)))
+    return value
+
+
+def _each(argument):
+    if isinstance(argument, dict) and '$each' in argument:
+        return argument['$each']
+    return [argument]
+
+
+def apply_update(document, update):
+    """
+    Apply an update document in place: either a replacement document or a
+    set of update operators
+    """
+    if not any(key.startswith('$') for key in update):
+        _id = document.get('_id')
+        document.clear()
+        document.update(copy.deepcopy(update))
+        if _id is not None:
+            document['_id'] = _id
+        return
+    for operator, changes in update.items():
+        for path, argument in changes.items():
+            parts = path.split('.')
+            if operator == '$set':
+                _set(document, parts, copy.deepcopy(argument))
+            elif operator == '$unset':
+                _unset(document, parts)
+            elif operator == '$inc':
+                value = _get(document, parts)
+                _set(document, parts,
+                     argument if value is _MISSING else value + argument)
+            elif operator == '$push':
+                _array(document, parts, operator).extend(
+                    copy.deepcopy(_each(argument)))
+            elif operator == '$addToSet':
+                array = _array(document, parts, operator)
+                for item in _each(argument):
+                    if item not in array:
+                        array.append(copy.deepcopy(item))
+            elif operator == '$pull':
+                array = _get(document, parts)
+                if isinstance(array, list):
+                    array[:] = [item for item in array
+                                if not _pulls(item, argument)]
+            elif operator == '$pop':
+                array = _get(document, parts)
+                if isinstance(array, list) and array:
+                    array.pop(0 if argument < 0 else -1)
+            else:
+                raise OperationFailure('unknown update operator: {}'.
+                                       format(operator))
+
+
+def _pulls(item, condition):
+    if _is_operator_dict(condition) or \
+            (isinstance(condition, dict) and isinstance(item, dict)):
+        return _match_element(item, condition)
+    return _equals([item], condition)
+
+
+class MemoryCursor(object):
+    """
+    The subset of pymongo's Cursor used by the models: results are filtered,
+    sorted and projected when iteration starts
+    """
+
+    def __init__(self, collection, spec=None, fields=None):
+        self.collection = collection
+        self._spec = spec or {}
+        self._fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+        self._results = None
+
+    def _check(self):
+        if self._results is not None:
+            raise InvalidOperation('cannot set options after executing '
+                                   'query')
+
+    def sort(self, key_or_list, direction=None):
+        self._check()
+        if isinstance(key_or_list, string_types):
+            key_or_list = [(key_or_list, direction or ASCENDING)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._check()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check()
+        self._limit = abs(limit)
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def _documents(self, with_limit_and_skip=True):
+        documents = self.collection._find(self._spec)
+        if self._sort:
+            _sort_documents(documents, self._sort)
+        if with_limit_and_skip:
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:self._limit]
+        return documents
+
+    def count(self, with_limit_and_skip=False):
+        return len(self._documents(with_limit_and_skip))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = iter(self._documents())
+        document = next(self._results)
+        return _copy(_project(document, self._fields))
+
+    __next__ = next
+
+    def rewind(self):
+        self._results = None
+        return self
+
+    def clone(self):
+        clone = MemoryCursor(self.collection, self._spec, self._fields)
+        clone._sort = self._sort
+        clone._skip = self._skip
+        clone._limit = self._limit
+        clone._batch_size = self._batch_size
+        return clone
+
+    def close(self):
+        self._results = iter([])
+
+
+def _sort_key(document, parts):
+    values = _lookup(document, parts)
+    if not values:
+        return None
+    return values[0]
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def _evaluate(document, expression):
+    """
+    The value of an aggregation expression: a '$field.path', a document or
+    list of expressions, an arithmetic operator or a literal.  Missing field
+    paths evaluate to _MISSING.
+    """
+    if isinstance(expression, string_types) and expression.startswith('$'):
+        return _get(document, expression[1:].split('.'))
+    if isinstance(expression, list):
+        return [_evaluate(document, item) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        operator, argument = next(iter(expression.items()))
+        if operator == '$literal':
+            return argument
+        if operator in _ARITHMETIC:
+            arguments = [_evaluate(document, item) for item in argument]
+            if any(value is _MISSING or value is None
+                   for value in arguments):
+                return None
+            return reduce(_ARITHMETIC[operator], arguments)
+    if any(key.startswith('$') for key in expression):
+        raise OperationFailure('unsupported expression: {}'.
+                               format(expression))
+    evaluated = dict()
+    for key, value in expression.items():
+        value = _evaluate(document, value)
+        if value is not _MISSING:
+            evaluated[key] = value
+    return evaluated
+
+
+def _accumulate(operator, values):
+    present = [value for value in values if value is not _MISSING]
+    numbers = [value for value in present if _is_number(value)]
+    if operator == '$sum':
+        return sum(numbers)
+    if operator == '$avg':
+        return float(sum(numbers)) / len(numbers) if numbers else None
+    if operator in ('$min', '$max'):
+        present = [value for value in present if value is not None]
+        if not present:
+            return None
+        pick = min if operator == '$min' else max
+        return pick(present, key=_sort_value)
+    if operator == '$first':
+        return present[0] if present else None
+    if operator == '$last':
+        return present[-1] if present else None
+    if operator == '$push':
+        return present
+    if operator == '$addToSet':
+        unique = list()
+        for value in present:
+            if value not in unique:
+                unique.append(value)
+        return unique
+    raise OperationFailure('unknown group operator: {}'.format(operator))
+
+
+def _group(documents, spec):
+    if '_id' not in spec:
+        raise OperationFailure('a group specification must include an _id')
+    groups = OrderedDict()
+    for document in documents:
+        key = _evaluate(document, spec['_id'])
+        if key is _MISSING:
+            key = None
+        groups.setdefault(_hashable(key), (key, list()))[1].append(document)
+    results = list()
+    for key, members in groups.values():
+        result = {'_id': key}
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                raise OperationFailure('the group aggregate field {} must '
+                                       'be an accumulator'.format(field))
+            operator, expression = next(iter(accumulator.items()))
+            result[field] = _accumulate(operator, [
+                _evaluate(member, expression) for member in members])
+        results.append(result)
+    return results
+
+
+def _is_inclusion(value):
+    return isinstance(value, (bool, int)) and bool(value)
+
+
+def _project_stage(document, spec):
+    fields = dict((k, v) for k, v in spec.items() if k != '_id')
+    if fields and all(isinstance(value, (bool, int)) and not value
+                      for value in fields.values()):
+        return _project(document, spec)
+    projected = dict()
+    id_spec = spec.get('_id', 1)
+    if _is_inclusion(id_spec):
+        if '_id' in document:
+            projected['_id'] = document['_id']
+    elif not isinstance(id_spec, (bool, int)):
+        projected['_id'] = _evaluate(document, id_spec)
+    for field, value in fields.items():
+        if _is_inclusion(value):
+            _copy_path(document, projected, field.split('.'))
+        else:
+            value = _evaluate(document, value)
+            if value is not _MISSING:
+                _set(projected, field.split('.'), value)
+    return projected
+
+
+def _unwind(documents, spec):
+    if isinstance(spec, dict):
+        path = spec['path']
+        preserve = spec.get('preserveNullAndEmptyArrays', False)
+    else:
+        path, preserve = spec, False
+    parts = path[1:].split('.')
+    for document in documents:
+        value = _get(document, parts)
+        if isinstance(value, list) and value:
+            for item in value:
+                unwound = copy.deepcopy(document)
+                _set(unwound, parts, item)
+                yield unwound
+        elif value is _MISSING or value is None or isinstance(value, list):
+            if preserve:
+                yield document
+        else:
+            yield document
+
+
+def _sort_documents(documents, keys):
+    for key, direction in reversed(list(keys)):
+        parts = key.split('.')
+        documents.sort(key=lambda document: _sort_value(
+            _sort_key(document, parts)), reverse=direction < 0)
+    return documents
+
+
+def run_pipeline(documents, pipeline):
+    """
+    Run an aggregation pipeline over a list of documents, supporting the
+    $match, $project, $group, $unwind, $sort, $skip, $limit and $count
+    stages.  The documents are never modified.
+    """
+    for stage in pipeline:
+        if len(stage) != 1:
+            raise OperationFailure('a pipeline stage specification must '
+                                   'contain exactly one field')
+        name, spec = next(iter(stage.items()))
+        if name == '$match':
+            documents = [document for document in documents
+                         if match(document, spec)]
+        elif name == '$project':
+            documents = [_project_stage(document, spec)
+                         for document in documents]
+        elif name == '$group':
+            documents = _group(documents, spec)
+        elif name == '$unwind':
+            documents = list(_unwind(documents, spec))
+        elif name == '$sort':
+            documents = _sort_documents(list(documents), spec.items())
+        elif name == '$skip':
+            documents = documents[spec:]
+        elif name == '$limit':
+            documents = documents[:spec]
+        elif name == '$count':
+            documents = [{spec: len(documents)}] if documents else []
+        else:
+            raise OperationFailure('Unrecognized pipeline stage name: {}'.
+                                   format(name))
+    return documents
+
+
+class MemoryCommandCursor(object):
+    """
+    The subset of pymongo's CommandCursor returned by aggregate(cursor={})
+    """
+
+    def __init__(self, documents):
+        self._documents = iter(documents)
+        self._batch_size = 0
+        self.alive = True
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return _copy(next(self._documents))
+        except StopIteration:
+            self.alive = False
+            raise
+
+    __next__ = next
+
+    def close(self):
+        self._documents = iter([])
+        self.alive = False
+
+
+class MemoryBulkOperation(object):
+    """
+    The subset of pymongo's BulkOperationBuilder used by the models
+    """
+
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.operations = list()
+        self.executed = False
+
+    def insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self.operations.append(('insert', document, None, False, False))
+
+    def find(self, selector):
+        return _BulkSelector(self, selector)
+
+    def execute(self, write_concern=None):
+        if self.executed:
+            raise InvalidOperation('Bulk operations can only be executed '
+                                   'once.')
+        if not self.operations:
+            raise InvalidOperation('No operations to execute')
+        self.executed = True
+        result = {'nInserted': 0, 'nMatched': 0, 'nModified': 0,
+                  'nRemoved': 0, 'nUpserted': 0, 'upserted': [],
+                  'writeErrors': [], 'writeConcernErrors': []}
+        collection = self.collection
+        for index, (kind, spec, update, multi, upsert) in \
+                enumerate(self.operations):
+            try:
+                if kind == 'insert':
+                    collection.insert(spec)
+                    result['nInserted'] += 1
+                elif kind == 'update':
+                    status = collection.update(spec, update, upsert=upsert,
+                                               multi=multi)
+                    if status.get('upserted') is not None:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': index, '_id': status['upserted']})
+                    else:
+                        result['nMatched'] += status['n']
+                        result['nModified'] += status['nModified']
+                else:
+                    status = collection.remove(spec, multi=multi)
+                    result['nRemoved'] += status['n']
+            except OperationFailure as e:
+                result['writeErrors'].append({
+                    'index': index, 'code': e.code, 'errmsg': str(e),
+                    'op': spec})
+                if self.ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class _BulkSelector(object):
+    def __init__(self, bulk, selector, upsert=False):
+        self.bulk = bulk
+        self.selector = selector
+        self._upsert = upsert
+
+    def upsert(self):
+        return _BulkSelector(self.bulk, self.selector, upsert=True)
+
+    def _add(self, kind, update, multi):
+        self.bulk.operations.append(
+            (kind, self.selector, update, multi, self._upsert))
+
+    def update(self, update):
+        self._add('update', update, True)
+
+    def update_one(self, update):
+        self._add('update', update, False)
+
+    def replace_one(self, document):
+        self._add('update', document, False)
+
+    def remove(self):
+        self._add('remove', None, True)
+
+    def remove_one(self):
+        self._add('remove', None, False)
+
+
+class _CollectionState(object):
+    """
+    The documents and indexes of a collection, shared by the collection
+    handles of every client on the same store
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.documents = OrderedDict()
+            self.indexes = {'_id_': {'key': [('_id', ASCENDING)]}}
+            # index name -> {key values: _id} for unique indexes
+            self.unique = dict()
+
+
+class MemoryCollection(object):
+    """
+    An in-process collection implementing the subset of pymongo 2.7's
+    Collection used by the models and the connector: queries with the
+    common operators, update operators, bulk writes, cursors and indexes,
+    including unique constraints.  TTL indexes are recorded but documents
+    never expire.
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database.name, name)
+        self.read_preference = None
+        self.write_concern = dict()
+        self._state = database._state(name)
+        self._lock = self._state.lock
+
+    def _find(self, spec):
+        if isinstance(spec, ObjectId):
+            spec = {'_id': spec}
+        with self._lock:
+            _id = spec.get('_id', _MISSING) if spec else _MISSING
+            if _id is not _MISSING and not isinstance(_id, dict):
+                document = self._state.documents.get(_hashable(_id))
+                if document is not None and match(document, spec):
+                    return [document]
+                return []
+            return [document for document in self._state.documents.values()
+                    if match(document, spec)]
+
+    def find(self, spec=None, fields=None, **kwargs):
+        cursor = MemoryCursor(self, spec, fields)
+        if kwargs.get('sort'):
+            cursor.sort(kwargs['sort'])
+        if kwargs.get('skip'):
+            cursor.skip(kwargs['skip'])
+        if kwargs.get('limit'):
+            cursor.limit(kwargs['limit'])
+        return cursor
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for document in self.find(spec_or_id, fields, **kwargs).limit(1):
+            return document
+        return None
+
+    def count(self):
+        return len(self._state.documents)
+
+    def _index_key(self, name, document):
+        info = self._state.indexes[name]
+        values = list()
+        for key, direction in info['key']:
+            found = _lookup(document, key.split('.'))
+            values.append(_hashable(found[0]) if found else _MISSING)
+        if info.get('sparse') and all(v is _MISSING for v in values):
+            return None
+        partial = info.get('partialFilterExpression')
+        if partial and not match(document, partial):
+            return None
+        return tuple(None if v is _MISSING else v for v in values)
+
+    def _check_unique(self, document, previous=None):
+        """
+        Raise DuplicateKeyError if the document would violate a unique
+        index
+        :param previous: the stored version of the document when updating
+        """
+        _id = _hashable(document['_id'])
+        if previous is None and _id in self._state.documents:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error index: {}.$_id_ dup key: {}'.
+                format(self.full_name, document['_id']), 11000)
+        for name, keys in self._state.unique.items():
+            key = self._index_key(name, document)
+            if key is not None and keys.get(key, _id) != _id:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: {}.${} dup key: {}'.
+                    format(self.full_name, name, key), 11000)
+
+    def _store(self, document, previous=None):
+        _id = _hashable(document['_id'])
+        for name, keys in self._state.unique.items():
+            if previous is not None:
+                key = self._index_key(name, previous)
+                if key is not None and keys.get(key) == _id:
+                    del keys[key]
+            key = self._index_key(name, document)
+            if key is not None:
+                keys[key] = _id
+        self._state.documents[_id] = document
+
+    def _delete(self, document):
+        _id = _hashable(document['_id'])
+        for name, keys in self._state.unique.items():
+            key = self._index_key(name, document)
+            if key is not None and keys.get(key) == _id:
+                del keys[key]
+        del self._state.documents[_id]
+
+    def insert(self, doc_or_docs, manipulate=True, **kwargs):
+        documents = doc_or_docs
+        if isinstance(doc_or_docs, dict):
+            documents = [doc_or_docs]
+        ids = list()
+        with self._lock:
+            for document in documents:
+                if '_id' not in document:
+                    document['_id'] = ObjectId()
+                stored = _copy(document)
+                self._check_unique(stored)
+                self._store(stored)
+                ids.append(document['_id'])
+        if isinstance(doc_or_docs, dict):
+            return ids[0]
+        return ids
+
+    def save(self, to_save, manipulate=True, **kwargs):
+        if not isinstance(to_save, dict):
+            # the message MongoModel.save relies on to skip empty models
+            raise TypeError("cannot save object of type {}".
+                            format(type(to_save)))
+        if '_id' not in to_save:
+            return self.insert(to_save)
+        self.update({'_id': to_save['_id']}, to_save, upsert=True)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self._lock:
+            matched = self._find(spec)
+            if not multi:
+                matched = matched[:1]
+            for stored in matched:
+                updated = copy.deepcopy(stored)
+                apply_update(updated, document)
+                if updated.get('_id') != stored['_id']:
+                    raise OperationFailure("The _id field cannot be "
+                                           "changed", 66)
+                updated = _copy(updated)
+                self._check_unique(updated, stored)
+                self._store(updated, stored)
+            if matched or not upsert:
+                return {'n': len(matched), 'nModified': len(matched),
+                        'updatedExisting': bool(matched), 'ok': 1.0}
+            inserted = dict((key, value) for key, value in spec.items()
+                            if not key.startswith('$') and
+                            not _is_operator_dict(value) and '.' not in key)
+            apply_update(inserted, document)
+            if '_id' not in inserted:
+                inserted['_id'] = spec.get('_id', ObjectId())
+            self.insert(inserted)
+            return {'n': 1, 'nModified': 0, 'updatedExisting': False,
+                    'upserted': inserted['_id'], 'ok': 1.0}
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self._lock:
+            matched = self._find(spec_or_id)
+            if not multi:
+                matched = matched[:1]
+            for document in matched:
+                self._delete(document)
+        return {'n': len(matched), 'ok': 1.0}
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulkOperation(self, True)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulkOperation(self, False)
+
+    def create_index(self, key_or_list, **kwargs):
+        if isinstance(key_or_list, string_types):
+            key_or_list = [(key_or_list, ASCENDING)]
+        keys = [(key, direction) for key, direction in key_or_list]
+        name = kwargs.pop('name', None) or '_'.join(
+            '{}_{}'.format(key, direction) for key, direction in keys)
+        kwargs.pop('background', None)
+        kwargs.pop('cache_for', None)
+        info = dict(kwargs)
+        info['key'] = keys
+        with self._lock:
+            existing = self._state.indexes.get(name)
+            if existing is not None:
+                if existing != info:
+                    raise OperationFailure('Index with name: {} already '
+                                           'exists with different options'.
+                                           format(name), 85)
+                return name
+            self._state.indexes[name] = info
+            if info.get('unique'):
+                unique = dict()
+                for _id, document in self._state.documents.items():
+                    key = self._index_key(name, document)
+                    if key is None:
+                        continue
+                    if key in unique:
+                        del self._state.indexes[name]
+                        raise DuplicateKeyError(
+                            'E11000 duplicate key error index: {}.${} dup '
+                            'key: {}'.format(self.full_name, name, key),
+                            11000)
+                    unique[key] = _id
+                self._state.unique[name] = unique
+        return name
+
+    ensure_index = create_index
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, string_types):
+            name = '_'.join('{}_{}'.format(key, direction)
+                            for key, direction in index_or_name)
+        with self._lock:
+            if name == '_id_' or name not in self._state.indexes:
+                raise OperationFailure('index not found with name [{}]'.
+                                       format(name), 27)
+            del self._state.indexes[name]
+            self._state.unique.pop(name, None)
+
+    def drop_indexes(self):
+        with self._lock:
+            for name in list(self._state.indexes):
+                if name != '_id_':
+                    self.drop_index(name)
+
+    def index_information(self):
+        return copy.deepcopy(self._state.indexes)
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Run the pipeline over a snapshot of the collection.  As with pymongo,
+        passing cursor={} returns a cursor, otherwise a command response;
+        other options such as allowDiskUse are accepted and ignored.
+        """
+        if isinstance(pipeline, dict):
+            pipeline = [pipeline]
+        with self._lock:
+            documents = list(self._state.documents.values())
+        documents = run_pipeline(documents, pipeline)
+        if 'cursor' in kwargs:
+            return MemoryCommandCursor(documents)
+        return {'result': [_copy(document) for document in documents],
+                'ok': 1.0}
+
+
+class MemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = dict()
+        self._lock = threading.Lock()
+
+    def _states(self):
+        return self.client._store.setdefault(self.name, dict())
+
+    def _state(self, name):
+        with self.client._lock:
+            states = self._states()
+            state = states.get(name)
+            if state is None:
+                state = states[name] = _CollectionState()
+            return state
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = \
+                    MemoryCollection(self, name)
+            return collection
+
+    def collection_names(self, include_system_collections=True):
+        return [name for name, state in self._states().items()
+                if state.documents or len(state.indexes) > 1]
+
+    def drop_collection(self, name_or_collection):
+        # collections are emptied rather than discarded, so handles held
+        # by callers (e.g. MongoConnector.tables) stay valid
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        state = self._states().get(name)
+        if state is not None:
+            state.clear()
+
+    def command(self, command, **kwargs):
+        if command.lower() == 'ismaster':
+            return {'ismaster': True, 'ok': 1.0}
+        if command == 'ping':
+            return {'ok': 1.0}
+        raise OperationFailure('no such command: {}'.format(command), 59)
+
+
+class MemoryClient(object):
+    """
+    Stands in for a MongoClient connected to a server living in this
+    process.  Clients created on the same store see the same databases.
+    """
+
+    def __init__(self, store=None):
+        self._store = store if store is not None else dict()
+        self._databases = dict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(self, name)
+        return database
+
+    def database_names(self):
+        return [name for name in self._store
+                if self[name].collection_names()]
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        for state in list(self._store.get(name, {}).values()):
+            state.clear()
+
+    def close(self):
+        pass
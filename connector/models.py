@@ -1,22 +1,101 @@
+import os
 import re
 import logging
+import threading
 import time
 import json
 
 log = logging.getLogger(__name__)
 
 from django.conf import settings
-from pymongo import MongoClient
 from pymongo.errors import AutoReconnect, ConnectionFailure
 
+from connector.backends import get_backend
+from connector.instrumentation import instrument
+from connector.signals import client_closed, client_created, process_forked
+
 HEALTH_CHECK_INTERVAL = 1
+RECONNECT_BACKOFF = 0.5
+RECONNECT_MAX_BACKOFF = 30
+
+# project setting -> MongoClient option
+CLIENT_OPTIONS = {
+    'MONGO_POOL_SIZE': 'max_pool_size',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_REPLICA_SET': 'replicaSet',
+}
+
+
+class TopologyMonitor(threading.Thread):
+    """
+    Daemon thread running the connector's health checks, so requests never
+    pay for them.  Checks run every MONGO_HEALTH_CHECK_INTERVAL seconds;
+    after a failure the connection is rebuilt and the delay before the next
+    check backs off exponentially up to MONGO_RECONNECT_MAX_BACKOFF.
+    """
+
+    def __init__(self, connector):
+        super(TopologyMonitor, self).__init__(name='mongo-topology-monitor')
+        self.daemon = True
+        self.connector = connector
+        self.interval = getattr(settings, 'MONGO_HEALTH_CHECK_INTERVAL',
+                                HEALTH_CHECK_INTERVAL)
+        self.backoff = getattr(settings, 'MONGO_RECONNECT_BACKOFF',
+                               RECONNECT_BACKOFF)
+        self.max_backoff = getattr(settings, 'MONGO_RECONNECT_MAX_BACKOFF',
+                                   RECONNECT_MAX_BACKOFF)
+        self._stopped = threading.Event()
+
+    def run(self):
+        delay = self.interval
+        while not self._stopped.is_set():
+            if self.connector._check_health(self):
+                delay = self.interval
+            elif delay < self.backoff:
+                delay = self.backoff
+            else:
+                delay = min(delay * 2, self.max_backoff)
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_stopped(self):
+        return self._stopped.is_set()
 
 
 class MongoConnector:
+    """
+    Process wide holder of the MongoClient.  Creating or replacing the
+    client is serialized by a lock, so concurrent threads never race to
+    connect.  Clients are not shared across processes: a forked child
+    drops the client, collections and monitor inherited from its parent
+    (on os.register_at_fork where available, otherwise when it first sees
+    a new PID) and connects on its own.  Servers can manage the lifecycle
+    explicitly with connect() and close(), and observe it through the
+    signals of connector.signals.
+    """
     camel_case_regex = re.compile('(.)([A-Z][a-z]+)')
     snake_case_regex = re.compile('([a-z0-9])([A-Z])')
     mongo_client = None
+    # the process owning mongo_client
+    pid = os.getpid()
+    _lock = threading.RLock()
     last_health_check_time = time.time()
+    monitor = None
+    next_connect_time = 0
+    # model class -> (client, collection), see get_table
+    tables = dict()
+    table_names = dict()
+    metrics = {
+        'healthy': None,
+        'reconnects': 0,
+        'failed_health_checks': 0,
+        'consecutive_failures': 0,
+        'last_error': None,
+    }
 
     REQUIRED_SETTINGS = ('MONGO_URI', 'MONGO_DATABASE')
 
@@ -43,47 +122,229 @@ class MongoConnector:
         return False
 
     @classmethod
-    def get_connection(cls, retries=10):
-        try:
-            if cls.mongo_client is None or not cls.mongo_client.alive():
-                cls.mongo_client = MongoClient(settings.MONGO_URI)
+    def _create_client(cls):
+        options = dict()
+        for setting, option in CLIENT_OPTIONS.items():
+            if getattr(settings, setting, None) is not None:
+                options[option] = getattr(settings, setting)
+        with instrument(None, 'connect') as operation:
+            with operation.server():
+                return get_backend().create_client(
+                    getattr(settings, 'MONGO_URI', None), **options)
+
+    @classmethod
+    def _connect(cls, monitor=None):
+        """
+        Create a client and make it the shared one, then close the client it
+        replaces so its sockets and monitoring threads are released
+        :param monitor: the TopologyMonitor replacing the client; nothing is
+            replaced once it has been stopped, e.g. by close()
+        :return: the new client, or None when the monitor was stopped
+        """
+        with cls._lock:
+            if monitor is not None and monitor.is_stopped():
+                return None
+            client = cls._create_client()
+            previous = cls.mongo_client
+            cls.mongo_client = client
+        client_created.send(sender=cls, client=client)
+        if previous is not None:
+            client_closed.send(sender=cls, client=previous)
+            previous.close()
+        return client
+
+    @classmethod
+    def _record_failure(cls, error):
+        with cls._lock:
+            cls.metrics['healthy'] = False
+            cls.metrics['consecutive_failures'] += 1
+            cls.metrics['last_error'] = error
+
+    @classmethod
+    def _after_fork(cls):
+        """
+        Forget the client, collections and monitor inherited from the
+        parent process: their sockets and threads belong to the parent.
+        The lock is replaced too, as it may have been held by a thread that
+        does not exist in this process.
+        """
+        parent_pid = cls.pid
+        cls._lock = threading.RLock()
+        cls.pid = os.getpid()
+        cls.mongo_client = None
+        cls.monitor = None
+        cls.next_connect_time = 0
+        cls.tables.clear()
+        process_forked.send(sender=cls, parent_pid=parent_pid, pid=cls.pid)
+
+    @classmethod
+    def _check_health(cls, monitor=None):
+        """
+        Run by the TopologyMonitor: check that the client is connected to a
+        master and replace it when it is not
+        :param monitor: the TopologyMonitor running the check
+        :return: whether the connection is healthy
+        """
+        cls.last_health_check_time = time.time()
+        if cls.mongo_client is None or not cls._isMaster():
+            cls.metrics['failed_health_checks'] += 1
+            try:
+                if cls._connect(monitor) is None:
+                    return False
+                cls.metrics['reconnects'] += 1
                 log.info('New Mongo connection')
-            if time.time() > (cls.last_health_check_time +
-                              HEALTH_CHECK_INTERVAL):
-                # will retry connect if not connected to a master
-                cls.last_health_check_time = time.time()
-                if not cls._isMaster():
-                    cls.mongo_client = None
-                    return cls.get_connection()
-        except (ConnectionFailure, AutoReconnect) as e:
+            except (ConnectionFailure, AutoReconnect) as e:
+                error = '{}: {}'.format(e.__class__.__name__, e)
+                log.info('Mongo reconnect failed. {}'.format(error))
+                cls._record_failure(error)
+                return False
+            if not cls._isMaster():
+                cls._record_failure('Not connected to a master server')
+                return False
+        cls.metrics['healthy'] = True
+        cls.metrics['consecutive_failures'] = 0
+        return True
+
+    @classmethod
+    def start_monitor(cls):
+        with cls._lock:
+            if getattr(settings, 'MONGO_HEALTH_MONITOR', True) and \
+                    (cls.monitor is None or not cls.monitor.is_alive()):
+                cls.monitor = TopologyMonitor(cls)
+                cls.monitor.start()
+
+    @classmethod
+    def stop_monitor(cls):
+        with cls._lock:
+            if cls.monitor is not None:
+                cls.monitor.stop()
+                cls.monitor = None
+
+    @classmethod
+    def connect(cls):
+        """
+        Connect now rather than on first use, e.g. from a server's
+        post-fork hook, so a worker that cannot reach MongoDB fails to
+        start instead of failing its first requests
+        :return: the client
+        """
+        return cls.get_connection()
+
+    @classmethod
+    def close(cls):
+        """
+        Stop the monitor and close the client, e.g. from a server's worker
+        exit hook, or in a master process before it forks its workers.
+        The next get_connection() connects again.
+        """
+        with cls._lock:
+            cls.stop_monitor()
+            client = cls.mongo_client
             cls.mongo_client = None
-            if retries > 0:
-                log.info('Retry mongo connection. '
-                         '{}: {}'.format(e.__class__.__name__, e))
-                time.sleep(0.5)
-                return cls.get_connection(retries=(retries-1))
-            log.error("Persistent errors while trying to get mongo connection."
-                      "{}: {}".format(e.__class__.__name__, e))
-            raise e
-        return cls.mongo_client
+            cls.tables.clear()
+        if client is not None:
+            client_closed.send(sender=cls, client=client)
+            client.close()
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        :return: the connection health and reconnect counters
+        """
+        metrics = dict(cls.metrics)
+        metrics['last_health_check_time'] = cls.last_health_check_time
+        return metrics
+
+    @classmethod
+    def get_connection(cls):
+        """
+        Return the shared client without any health checks or retries on
+        the request path; those are left to the TopologyMonitor.  While
+        connecting fails, further attempts are refused until the backoff
+        delay has passed, so callers fail fast instead of piling up.
+        """
+        client = cls.mongo_client
+        if cls.pid != os.getpid():
+            cls._after_fork()
+        elif client is not None:
+            return client
+        with cls._lock:
+            # another thread may have connected while this one waited
+            client = cls.mongo_client
+            if client is not None:
+                return client
+            if time.time() < cls.next_connect_time:
+                raise AutoReconnect('MongoDB unavailable: {}'.
+                                    format(cls.metrics['last_error']))
+            try:
+                client = cls._connect()
+                log.info('New Mongo connection')
+            except (ConnectionFailure, AutoReconnect) as e:
+                error = '{}: {}'.format(e.__class__.__name__, e)
+                log.error("Error while trying to get mongo connection. "
+                          "{}".format(error))
+                cls._record_failure(error)
+                cls.next_connect_time = time.time() + getattr(
+                    settings, 'MONGO_RECONNECT_BACKOFF', RECONNECT_BACKOFF)
+                raise
+            finally:
+                cls.start_monitor()
+        return client
 
     @classmethod
     def get_database(cls):
         return cls.get_connection()[settings.MONGO_DATABASE]
 
+    @classmethod
+    def get_table_name(cls, klass):
+        """
+        The collection name of a class: its _collection_name if set,
+        otherwise the class name in snake case
+        """
+        if not isinstance(klass, type):
+            klass = klass.__class__
+        table_name = cls.table_names.get(klass)
+        if table_name is None:
+            table_name = getattr(klass, '_collection_name', None)
+            if not table_name:
+                s1 = cls.camel_case_regex.sub(r'\1_\2', klass.__name__)
+                table_name = cls.snake_case_regex.sub(r'\1_\2', s1).lower()
+            cls.table_names[klass] = table_name
+        return table_name
+
     @classmethod
     def get_table(cls, klass):
-        if hasattr(klass, '__name__'):
-            name = klass.__name__
-        else:
-            name = klass.__class__.__name__
-        s1 = cls.camel_case_regex.sub(r'\1_\2', name)
-        table_name = cls.snake_case_regex.sub(r'\1_\2', s1).lower()
-        return cls.get_database()[table_name]
+        """
+        The collection of a class, resolved once per class and client.  The
+        class may set _read_preference (a pymongo ReadPreference) and
+        _write_concern (e.g. {'w': 'majority'}) to route its operations.
+        Read preferences take effect through mongos or on a replica set
+        named by MONGO_URI or MONGO_REPLICA_SET; a plain MongoClient
+        connected to a replica set reads from the primary regardless.
+        """
+        if not isinstance(klass, type):
+            klass = klass.__class__
+        client = cls.get_connection()
+        entry = cls.tables.get(klass)
+        if entry is not None and entry[0] is client:
+            return entry[1]
+        table = client[settings.MONGO_DATABASE][cls.get_table_name(klass)]
+        read_preference = getattr(klass, '_read_preference', None)
+        if read_preference is not None:
+            table.read_preference = read_preference
+        write_concern = getattr(klass, '_write_concern', None)
+        if write_concern:
+            table.write_concern = write_concern
+        cls.tables[klass] = (client, table)
+        return table
 
     @classmethod
     def drop_database(cls):
         """
         This is to clear out the database -- should only be used for tests
         """
-        cls.get_connection().drop_database(cls.get_database())
\ No newline at end of file
+        cls.get_connection().drop_database(cls.get_database())
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MongoConnector._after_fork)
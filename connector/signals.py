@@ -0,0 +1,11 @@
+from django.dispatch import Signal
+
+# sent by MongoConnector with each client it creates
+client_created = Signal(providing_args=['client'])
+
+# sent by MongoConnector.close() before it closes the client
+client_closed = Signal(providing_args=['client'])
+
+# sent in a forked child process before it creates its own client; the
+# client inherited from the parent has been dropped, not closed
+process_forked = Signal(providing_args=['parent_pid', 'pid'])
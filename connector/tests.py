@@ -1,3 +1,309 @@
+import threading
+import time
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from pymongo import MongoClient, MongoReplicaSetClient
+from pymongo.errors import AutoReconnect, BulkWriteError, \
+    ConnectionFailure, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import ReadPreference
+
+from connector.backends import PymongoBackend
+from connector.memory import MemoryClient
+from connector.models import MongoConnector, TopologyMonitor
+from connector.signals import client_closed, client_created, process_forked
+
+
+class CamelCaseModel(object):
+    pass
+
+
+class RoutedModel(object):
+    _collection_name = 'routed'
+    _read_preference = ReadPreference.SECONDARY_PREFERRED
+    _write_concern = {'w': 'majority'}
+
+
+@override_settings(MONGO_HEALTH_MONITOR=False)
+class MongoConnectorTest(TestCase):
+    def setUp(self):
+        monitor = MongoConnector.monitor
+        MongoConnector.stop_monitor()
+        if monitor is not None:
+            monitor.join()
+        self.saved = dict((attr, MongoConnector.__dict__[attr]) for attr in
+                          ('mongo_client', 'next_connect_time', '_isMaster',
+                           '_create_client', 'pid', '_lock'))
+        self.saved_metrics = dict(MongoConnector.metrics)
+        MongoConnector.metrics.update(healthy=None, reconnects=0,
+                                      failed_health_checks=0,
+                                      consecutive_failures=0)
+
+    def tearDown(self):
+        for attr, value in self.saved.items():
+            setattr(MongoConnector, attr, value)
+        MongoConnector.metrics.update(self.saved_metrics)
+
+    def _fail_to_connect(self):
+        def _create_client(cls):
+            raise ConnectionFailure('unreachable')
+        MongoConnector._create_client = classmethod(_create_client)
+
+    def test_no_health_check_on_request_path(self):
+        client = MongoConnector.get_connection()
+
+        def _isMaster(cls):
+            raise AssertionError('health check on the request path')
+        MongoConnector._isMaster = classmethod(_isMaster)
+        self.assertIs(MongoConnector.get_connection(), client)
+
+    @override_settings(MONGO_RECONNECT_BACKOFF=60)
+    def test_connect_backoff(self):
+        MongoConnector.mongo_client = None
+        MongoConnector.next_connect_time = 0
+        self._fail_to_connect()
+        with self.assertRaises(ConnectionFailure):
+            MongoConnector.get_connection()
+        with self.assertRaises(AutoReconnect):
+            MongoConnector.get_connection()
+        metrics = MongoConnector.get_metrics()
+        self.assertFalse(metrics['healthy'])
+        self.assertEqual(metrics['last_error'],
+                         'ConnectionFailure: unreachable')
+
+    def test_health_check_reconnects(self):
+        MongoConnector.get_connection()
+        MongoConnector._isMaster = classmethod(lambda cls: False)
+        self.assertFalse(MongoConnector._check_health())
+        self.assertEqual(MongoConnector.metrics['reconnects'], 1)
+
+        self._fail_to_connect()
+        self.assertFalse(MongoConnector._check_health())
+        self.assertEqual(MongoConnector.metrics['consecutive_failures'], 2)
+
+        MongoConnector._isMaster = classmethod(lambda cls: True)
+        self.assertTrue(MongoConnector._check_health())
+        self.assertTrue(MongoConnector.get_metrics()['healthy'])
+        self.assertEqual(MongoConnector.metrics['consecutive_failures'], 0)
+
+    def test_health_check_closes_replaced_client(self):
+        client = MongoConnector.get_connection()
+        MongoConnector._isMaster = classmethod(lambda cls: False)
+        closed = list()
+
+        def record(sender, client, **kwargs):
+            closed.append(client)
+        client_closed.connect(record)
+        try:
+            MongoConnector._check_health()
+        finally:
+            client_closed.disconnect(record)
+        self.assertEqual(closed, [client])
+        self.assertIsNot(MongoConnector.mongo_client, client)
+
+    def test_stopped_monitor_does_not_reconnect(self):
+        monitor = TopologyMonitor(MongoConnector)
+        monitor.stop()
+        MongoConnector.mongo_client = None
+        self.assertFalse(MongoConnector._check_health(monitor))
+        self.assertIsNone(MongoConnector.mongo_client)
+
+    def test_concurrent_connect(self):
+        MongoConnector.mongo_client = None
+        created = list()
+        create_client = MongoConnector._create_client
+
+        def _create_client(cls):
+            time.sleep(0.01)
+            created.append(create_client())
+            return created[-1]
+        MongoConnector._create_client = classmethod(_create_client)
+        clients = list()
+        threads = [threading.Thread(target=lambda: clients.append(
+            MongoConnector.get_connection())) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertEqual(set(map(id, clients)), set([id(created[0])]))
+
+    def test_after_fork(self):
+        client = MongoConnector.get_connection()
+        MongoConnector.get_table(CamelCaseModel)
+        events = list()
+
+        def forked(sender, parent_pid, pid, **kwargs):
+            events.append(('forked', parent_pid))
+
+        def created(sender, client, **kwargs):
+            events.append(('created', client))
+        process_forked.connect(forked)
+        client_created.connect(created)
+        try:
+            # as seen by a child process that did not run at-fork hooks
+            MongoConnector.pid = -1
+            new_client = MongoConnector.get_connection()
+        finally:
+            process_forked.disconnect(forked)
+            client_created.disconnect(created)
+        self.assertIsNot(new_client, client)
+        self.assertEqual(events, [('forked', -1), ('created', new_client)])
+        self.assertNotIn(CamelCaseModel, MongoConnector.tables)
+        self.assertIs(MongoConnector.get_connection(), new_client)
+
+    def test_close(self):
+        client = MongoConnector.connect()
+        closed = list()
+
+        def record(sender, client, **kwargs):
+            closed.append(client)
+        client_closed.connect(record)
+        try:
+            MongoConnector.close()
+        finally:
+            client_closed.disconnect(record)
+        self.assertEqual(closed, [client])
+        self.assertIsNone(MongoConnector.mongo_client)
+        self.assertIsNot(MongoConnector.connect(), client)
+
+
+class CollectionRegistryTest(TestCase):
+    def test_table_name(self):
+        self.assertEqual(MongoConnector.get_table_name(CamelCaseModel),
+                         'camel_case_model')
+        self.assertEqual(MongoConnector.get_table_name(CamelCaseModel()),
+                         'camel_case_model')
+        self.assertEqual(MongoConnector.get_table_name(RoutedModel),
+                         'routed')
+
+    def test_table_cached(self):
+        table = MongoConnector.get_table(RoutedModel)
+        self.assertIs(MongoConnector.get_table(RoutedModel()), table)
+        self.assertEqual(table.name, 'routed')
+        self.assertEqual(table.read_preference,
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(table.write_concern, {'w': 'majority'})
+
+    def test_new_client(self):
+        table = MongoConnector.get_table(CamelCaseModel)
+        client = MongoConnector.mongo_client
+        try:
+            MongoConnector.mongo_client = MongoConnector._create_client()
+            self.assertIsNot(MongoConnector.get_table(CamelCaseModel), table)
+        finally:
+            MongoConnector.mongo_client = client
+
+
+class PymongoBackendTest(TestCase):
+    def test_client_class(self):
+        client_class = PymongoBackend.client_class
+        self.assertIs(client_class('mongodb://localhost:27017'), MongoClient)
+        self.assertIs(client_class(None), MongoClient)
+        self.assertIs(client_class('mongodb://a,b/?replicaSet=rs0'),
+                      MongoReplicaSetClient)
+        self.assertIs(client_class('mongodb://a,b', replicaSet='rs0'),
+                      MongoReplicaSetClient)
+
+
+class MemoryBackendTest(TestCase):
+    def setUp(self):
+        self.table = MemoryClient()['test']['documents']
+        self.table.insert([{'name': 'a', 'value': 1, 'tags': ['x', 'y']},
+                           {'name': 'b', 'value': 2, 'inner': {'n': 1}},
+                           {'name': 'c', 'value': 3}])
+
+    def test_find(self):
+        table = self.table
+        self.assertEqual(table.find({'value': {'$gte': 2}}).count(), 2)
+        self.assertEqual(table.find({'tags': 'x'}).count(), 1)
+        self.assertEqual(table.find({'inner.n': 1}).count(), 1)
+        self.assertEqual(table.find({'inner': {'$exists': False}}).count(), 2)
+        self.assertEqual(table.find({'$or': [{'name': 'a'},
+                                             {'value': 3}]}).count(), 2)
+        self.assertEqual(table.find({'name': {'$in': ['a', 'b']},
+                                     'value': {'$ne': 1}}).count(), 1)
+        names = [d['name'] for d in table.find().sort('value', -1).skip(1)]
+        self.assertEqual(names, ['b', 'a'])
+        self.assertEqual(sorted(table.find_one({'name': 'a'}, ['value'])),
+                         ['_id', 'value'])
+        with self.assertRaises(OperationFailure):
+            table.find_one({'$where': 'true'})
+
+    def test_update(self):
+        table = self.table
+        table.update({'name': 'a'}, {'$set': {'inner.n': 2},
+                                     '$push': {'tags': {'$each': ['z']}},
+                                     '$inc': {'value': 10}})
+        table.update({'name': 'a'}, {'$pull': {'tags': {'$in': ['x']}},
+                                     '$unset': {'name': ''}})
+        document = table.find_one({'value': 11})
+        self.assertEqual(document['tags'], ['y', 'z'])
+        self.assertEqual(document['inner'], {'n': 2})
+        self.assertNotIn('name', document)
+
+        table.update({'value': {'$gt': 1}}, {'$set': {'flag': True}},
+                     multi=True)
+        self.assertEqual(table.find({'flag': True}).count(), 3)
+        table.update({'name': 'd'}, {'$set': {'value': 4}}, upsert=True)
+        self.assertEqual(table.find_one({'value': 4})['name'], 'd')
+
+    def test_documents_are_copied(self):
+        document = self.table.find_one({'name': 'a'})
+        document['tags'].append('changed')
+        self.assertEqual(self.table.find_one({'name': 'a'})['tags'],
+                         ['x', 'y'])
+
+    def test_save_non_document(self):
+        with self.assertRaises(TypeError) as context:
+            self.table.save(None)
+        self.assertEqual(str(context.exception),
+                         "cannot save object of type <type 'NoneType'>")
+
+    def test_unique_index(self):
+        table = self.table
+        table.create_index([('name', 1)], name='name_1', unique=True)
+        self.assertTrue(table.index_information()['name_1']['unique'])
+        with self.assertRaises(DuplicateKeyError):
+            table.insert({'name': 'a'})
+        with self.assertRaises(DuplicateKeyError):
+            table.update({'name': 'b'}, {'$set': {'name': 'a'}})
+        table.remove({'name': 'a'})
+        table.insert({'name': 'a'})
+
+        bulk = table.initialize_ordered_bulk_op()
+        bulk.insert({'name': 'e'})
+        bulk.insert({'name': 'e'})
+        bulk.insert({'name': 'f'})
+        with self.assertRaises(BulkWriteError) as cm:
+            bulk.execute()
+        self.assertEqual(cm.exception.details['nInserted'], 1)
+        self.assertEqual(cm.exception.details['writeErrors'][0]['index'], 1)
+
+    def test_aggregate(self):
+        table = self.table
+        pipeline = [{'$unwind': '$tags'},
+                    {'$group': {'_id': '$name', 'tags': {'$push': '$tags'},
+                                'value': {'$max': '$value'}}}]
+        self.assertEqual(list(table.aggregate(pipeline, cursor={})),
+                         [{'_id': 'a', 'tags': ['x', 'y'], 'value': 1}])
+        result = table.aggregate([
+            {'$match': {'value': {'$gte': 2}}},
+            {'$project': {'_id': 0, 'name': 1,
+                          'double': {'$multiply': ['$value', 2]}}},
+            {'$sort': {'double': -1}}, {'$limit': 1}])
+        self.assertEqual(result['result'], [{'name': 'c', 'double': 6}])
+        self.assertEqual(list(table.aggregate(
+            [{'$count': 'n'}], cursor={})), [{'n': 3}])
+        with self.assertRaises(OperationFailure):
+            table.aggregate([{'$lookup': {}}])
 
-# Create your tests here.
+    def test_shared_store(self):
+        client = MemoryClient()
+        other = MemoryClient(client._store)
+        client['test']['documents'].insert({'name': 'a'})
+        self.assertIsNot(other['test']['documents'],
+                         client['test']['documents'])
+        self.assertEqual(other['test']['documents'].count(), 1)
+        other.drop_database('test')
+        self.assertEqual(client['test']['documents'].count(), 0)
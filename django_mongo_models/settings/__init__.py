@@ -34,6 +34,8 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'connector',
+    'mongo_models',
 )
 
 MIDDLEWARE_CLASSES = (
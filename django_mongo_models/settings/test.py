@@ -0,0 +1,9 @@
+from django_mongo_models.settings import *  # noqa
+
+SECRET_KEY = 'test'
+
+# run the test suite against the in-process backend, no server needed
+MONGO_BACKEND = 'memory'
+MONGO_URI = 'mongodb://localhost:27017'
+MONGO_DATABASE = 'django_mongo_models_test'
+MONGO_HEALTH_MONITOR = False
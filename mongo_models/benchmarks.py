@@ -0,0 +1,242 @@
+import datetime
+import gc
+import json
+import timeit
+
+from connector.models import MongoConnector
+from mongo_models.models import base_models, fields
+
+DEFAULT_COUNTS = (100, 1000)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+LIST_SIZE = 100
+
+
+class BenchmarkLeaf(base_models.MongoModel):
+    name = fields.MongoStringField()
+    value = fields.MongoIntegerField()
+    _collection_name = 'benchmark_leaf'
+
+
+class BenchmarkFlat(base_models.MongoModel):
+    name = fields.MongoStringField()
+    value = fields.MongoIntegerField()
+    ratio = fields.MongoDecimalField()
+    active = fields.MongoBooleanField()
+    created = fields.MongoDateTimeField()
+    owner = fields.MongoStringField()
+    score = fields.MongoIntegerField()
+    note = fields.MongoStringField()
+    _collection_name = 'benchmark_flat'
+
+
+class BenchmarkBranch(base_models.MongoModel):
+    name = fields.MongoStringField()
+    leaf = BenchmarkLeaf()
+    leaves = base_models.MongoList(BenchmarkLeaf)
+    _collection_name = 'benchmark_branch'
+
+
+class BenchmarkTrunk(base_models.MongoModel):
+    name = fields.MongoStringField()
+    branch = BenchmarkBranch()
+    _collection_name = 'benchmark_trunk'
+
+
+class BenchmarkNested(base_models.MongoModel):
+    label = fields.MongoStringField()
+    trunk = BenchmarkTrunk()
+    _collection_name = 'benchmark_nested'
+
+
+class BenchmarkListHeavy(base_models.MongoModel):
+    label = fields.MongoStringField()
+    items = base_models.MongoList(BenchmarkLeaf)
+    _collection_name = 'benchmark_list_heavy'
+
+
+def _leaf(i):
+    return {'name': 'leaf{}'.format(i), 'value': i}
+
+
+def _flat_document(i):
+    return {'name': 'flat{}'.format(i), 'value': i, 'ratio': i / 7.0,
+            'active': i % 2 == 0,
+            'created': datetime.datetime(2016, 1, 1) +
+            datetime.timedelta(seconds=i),
+            'owner': 'owner{}'.format(i % 10), 'score': i * 3,
+            'note': 'x' * 32}
+
+
+def _nested_document(i):
+    return {'label': 'nested{}'.format(i), 'trunk': {
+        'name': 'trunk{}'.format(i), 'branch': {
+            'name': 'branch{}'.format(i), 'leaf': _leaf(i),
+            'leaves': [_leaf(j) for j in range(3)]}}}
+
+
+def _list_heavy_document(i):
+    return {'label': 'list{}'.format(i),
+            'items': [_leaf(j) for j in range(LIST_SIZE)]}
+
+
+# shape name -> (model, function building its i-th document)
+SHAPES = {
+    'flat': (BenchmarkFlat, _flat_document),
+    'nested': (BenchmarkNested, _nested_document),
+    'list_heavy': (BenchmarkListHeavy, _list_heavy_document),
+}
+
+
+def _hydrate(model, documents):
+    return [model()._set_values(document, set_original=True)
+            for document in documents]
+
+
+def _read_embedded(model):
+    """
+    Read every embedded model and list of a model, their items' included,
+    so the cost of building them is measured wherever they are lazy
+    """
+    for field, slot in model._meta['embedded']:
+        value = getattr(model, field)
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, base_models.MongoModel):
+                    _read_embedded(item)
+        elif value is not None:
+            _read_embedded(value)
+    return model
+
+
+def _micro_benchmarks(model, documents):
+    """
+    :return: benchmark name -> (setup, run) where setup() prepares the
+        input of run(input)
+    """
+    return {
+        'init': (lambda: len(documents),
+                 lambda count: [model() for i in range(count)]),
+        'set_values': (lambda: documents,
+                       lambda docs: _hydrate(model, docs)),
+        'set_values_read': (lambda: documents,
+                            lambda docs: [_read_embedded(m) for m in
+                                          _hydrate(model, docs)]),
+        'decode_on_access': (lambda: documents,
+                             lambda docs: [model._from_document(
+                                 document, decode_on_access=True)
+                                 for document in docs]),
+        'get_values': (lambda: _hydrate(model, documents),
+                       lambda models: [m._get_values() for m in models]),
+        'dirty_fields': (lambda: _hydrate(model, documents),
+                         lambda models: [(m.get_dirty_fields(),
+                                          m._get_update())
+                                         for m in models]),
+        'build_query': (lambda: _hydrate(model, documents),
+                        lambda models: [m._build_query(all_fields=True)
+                                        for m in models]),
+    }
+
+
+def _drop(model):
+    MongoConnector.get_table(model).drop()
+
+
+def _saved(model, documents):
+    _drop(model)
+    models = [model()._set_values(document) for document in documents]
+    model.save_many(models)
+    return models
+
+
+def _end_to_end_benchmarks(model, documents):
+    def new_models():
+        _drop(model)
+        return [model()._set_values(document) for document in documents]
+
+    def save(models):
+        for m in models:
+            m.save()
+
+    return {
+        'save': (new_models, save),
+        'save_many': (new_models, model.save_many),
+        'find': (lambda: _saved(model, documents),
+                 lambda models: list(model.find())),
+        'get_by_id': (lambda: [m._id for m in _saved(model, documents)],
+                      lambda ids: [model.get_by_id(_id) for _id in ids]),
+    }
+
+
+def _time(setup, run, repeat):
+    best = None
+    for i in range(repeat):
+        value = setup()
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = timeit.default_timer()
+            run(value)
+            elapsed = timeit.default_timer() - start
+        finally:
+            if enabled:
+                gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmarks(counts=DEFAULT_COUNTS, repeat=DEFAULT_REPEAT,
+                   shapes=None, end_to_end=True, only=None):
+    """
+    Time the model layer's hot paths for each model shape and document
+    count.  End-to-end benchmarks go through MongoConnector, so they
+    measure whichever MONGO_BACKEND is configured; use the memory backend
+    to isolate the model layer's CPU cost from network I/O.
+    :param counts: the numbers of documents to run each benchmark with
+    :param repeat: runs per benchmark; the fastest one is kept
+    :param shapes: names of SHAPES to run, all by default
+    :param end_to_end: also run the save/find benchmarks
+    :param only: substrings selecting benchmarks by name
+    :return: a dict of benchmark name ('shape.benchmark.count') to seconds
+    """
+    results = dict()
+    for shape in sorted(shapes or SHAPES):
+        model, document = SHAPES[shape]
+        for count in counts:
+            documents = [document(i) for i in range(count)]
+            benchmarks = _micro_benchmarks(model, documents)
+            if end_to_end:
+                benchmarks.update(_end_to_end_benchmarks(model, documents))
+            for name, (setup, run) in sorted(benchmarks.items()):
+                key = '{}.{}.{}'.format(shape, name, count)
+                if only and not any(part in key for part in only):
+                    continue
+                results[key] = _time(setup, run, repeat)
+            if end_to_end:
+                _drop(model)
+    return results
+
+
+def save_baseline(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    :param threshold: the slowdown ratio above which a benchmark regressed
+    :return: a list of (name, baseline, current) for each benchmark more
+        than threshold slower than its baseline
+    """
+    regressions = list()
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous and seconds > previous * (1 + threshold):
+            regressions.append((name, previous, seconds))
+    return regressions
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mongo_models import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the model layer: hydration, serialization, dirty ' \
+           'tracking and queries for flat, nested and list-heavy models, ' \
+           'plus end-to-end save/find throughput on the configured backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--counts', default=','.join(
+            str(count) for count in benchmarks.DEFAULT_COUNTS),
+            help='Comma separated document counts')
+        parser.add_argument('--repeat', type=int,
+                            default=benchmarks.DEFAULT_REPEAT,
+                            help='Runs per benchmark, the fastest is kept')
+        parser.add_argument('--shape', action='append', dest='shapes',
+                            choices=sorted(benchmarks.SHAPES),
+                            help='Only run the given model shapes')
+        parser.add_argument('--only', action='append',
+                            help='Only run benchmarks whose name contains '
+                                 'this')
+        parser.add_argument('--no-end-to-end', action='store_false',
+                            dest='end_to_end', default=True,
+                            help='Skip the save/find benchmarks')
+        parser.add_argument('--save', metavar='PATH',
+                            help='Save the results as a baseline')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Compare the results with a baseline')
+        parser.add_argument('--threshold', type=float,
+                            default=benchmarks.DEFAULT_THRESHOLD,
+                            help='Slowdown ratio flagged as a regression')
+
+    def handle(self, *args, **options):
+        counts = [int(count) for count in options['counts'].split(',')]
+        results = benchmarks.run_benchmarks(
+            counts=counts, repeat=options['repeat'],
+            shapes=options['shapes'], end_to_end=options['end_to_end'],
+            only=options['only'])
+        baseline = dict()
+        if options['compare']:
+            baseline = benchmarks.load_baseline(options['compare'])
+        for name, seconds in sorted(results.items()):
+            line = '{:<40} {:>10.2f} ms'.format(name, seconds * 1000)
+            if baseline.get(name):
+                line += ' {:>+7.1%}'.format(seconds / baseline[name] - 1)
+            self.stdout.write(line)
+        if options['save']:
+            benchmarks.save_baseline(results, options['save'])
+        if options['compare']:
+            regressions = benchmarks.compare(results, baseline,
+                                             options['threshold'])
+            for name, previous, seconds in regressions:
+                self.stderr.write('{} regressed: {:.2f} ms -> {:.2f} ms'.
+                                  format(name, previous * 1000,
+                                         seconds * 1000))
+            if regressions:
+                raise CommandError('{} benchmarks regressed by more than '
+                                   '{:.0%}'.format(len(regressions),
+                                                   options['threshold']))
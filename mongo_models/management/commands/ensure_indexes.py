@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from mongo_models.models.base_models import get_models
+from mongo_models.models.indexes import ensure_indexes, get_indexes
+
+
+class Command(BaseCommand):
+    help = 'Create the indexes declared by MongoModels (including those ' \
+           'implied by _unique_on) that are missing on the server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help='Model class names, all models by default')
+        parser.add_argument('--drop', action='store_true', default=False,
+                            help='Drop indexes that are no longer declared')
+        parser.add_argument('--foreground', action='store_true',
+                            default=False,
+                            help='Build indexes in the foreground')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the changes')
+
+    def handle(self, *args, **options):
+        models = [model for model in get_models() if get_indexes(model)]
+        if options['models']:
+            models = [model for model in models
+                      if model.__name__ in options['models']]
+        for model in models:
+            created, dropped = ensure_indexes(
+                model, background=not options['foreground'],
+                drop=options['drop'], dry_run=options['dry_run'])
+            for name in dropped:
+                self.stdout.write('{}: dropped {}'.format(
+                    model.__name__, name))
+            for name in created:
+                self.stdout.write('{}: created {}'.format(
+                    model.__name__, name))
@@ -0,0 +1,52 @@
+from bson import json_util
+from django.core.management.base import BaseCommand, CommandError
+
+from mongo_models import transfer
+from mongo_models.models.base_models import get_models
+
+
+def get_model(name):
+    for model in get_models():
+        if model.__name__ == name:
+            return model
+    raise CommandError('Unknown model {}'.format(name))
+
+
+class Command(BaseCommand):
+    help = 'Stream the collection of a MongoModel to a JSONL or BSON ' \
+           'file, gzipped when the path ends with .gz'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Model class name')
+        parser.add_argument('path', help='The file to write')
+        parser.add_argument('--query',
+                            help='Only export the documents matching this '
+                                 'extended JSON query')
+        parser.add_argument('--format', choices=transfer.FORMATS,
+                            help='By default guessed from the extension')
+        parser.add_argument('--gzip', action='store_true', default=None,
+                            dest='compress', help='Compress the file')
+        parser.add_argument('--raw', action='store_true', default=False,
+                            help='Write the documents as stored instead '
+                                 'of serializing them through the model')
+        parser.add_argument('--batch-size', type=int,
+                            default=transfer.DEFAULT_BATCH_SIZE,
+                            help='Documents per batch and checkpoint')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Continue an interrupted export')
+
+    def handle(self, *args, **options):
+        model = get_model(options['model'])
+        query = None
+        if options['query']:
+            query = json_util.loads(options['query'])
+        try:
+            count = transfer.export_documents(
+                model, options['path'], query=query,
+                format=options['format'], compress=options['compress'],
+                raw=options['raw'], batch_size=options['batch_size'],
+                resume=options['resume'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write('Exported {} {} documents to {}'.format(
+            count, model.__name__, options['path']))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mongo_models import transfer
+from mongo_models.management.commands.export_documents import get_model
+
+
+class Command(BaseCommand):
+    help = 'Load a JSONL or BSON file, gzipped when the path ends with ' \
+           '.gz, into the collection of a MongoModel with bulk writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Model class name')
+        parser.add_argument('path', help='The file to read')
+        parser.add_argument('--format', choices=transfer.FORMATS,
+                            help='By default guessed from the extension')
+        parser.add_argument('--gzip', action='store_true', default=None,
+                            dest='compress', help='The file is compressed')
+        parser.add_argument('--raw', action='store_true', default=False,
+                            help='Write the documents as read instead of '
+                                 'validating them through the model')
+        parser.add_argument('--batch-size', type=int,
+                            default=transfer.DEFAULT_BATCH_SIZE,
+                            help='Documents per bulk write and checkpoint')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Continue an interrupted import')
+        parser.add_argument('--ordered', action='store_true', default=False,
+                            help='Stop at the first failing write')
+
+    def handle(self, *args, **options):
+        model = get_model(options['model'])
+        try:
+            count = transfer.import_documents(
+                model, options['path'], format=options['format'],
+                compress=options['compress'], raw=options['raw'],
+                batch_size=options['batch_size'],
+                resume=options['resume'], ordered=options['ordered'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write('Imported {} {} documents from {}'.format(
+            count, model.__name__, options['path']))
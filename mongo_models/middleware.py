@@ -0,0 +1,29 @@
+from mongo_models.models.session import Session
+
+
+class MongoSessionMiddleware(object):
+    """
+    Wraps each request in a Session: models loaded during the request share
+    one identity map and dirty models are saved once the response is ready.
+    Nothing is saved when the view raises or returns a server error.
+    """
+
+    def process_request(self, request):
+        request.mongo_session = Session().begin()
+
+    def process_exception(self, request, exception):
+        session = getattr(request, 'mongo_session', None)
+        if session is not None:
+            session.close()
+            del request.mongo_session
+
+    def process_response(self, request, response):
+        session = getattr(request, 'mongo_session', None)
+        if session is not None:
+            try:
+                if response.status_code < 500:
+                    session.commit()
+            finally:
+                session.close()
+                del request.mongo_session
+        return response
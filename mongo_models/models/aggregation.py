@@ -0,0 +1,143 @@
+from itertools import islice
+
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING
+
+from connector.instrumentation import instrument
+from connector.models import MongoConnector
+from mongo_models.models.indexes import check_query
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def _field_path(field):
+    return field if field.startswith('$') else '${}'.format(field)
+
+
+def _group_key(by):
+    if by is None:
+        return None
+    if isinstance(by, (list, tuple)):
+        return dict((field.replace('.', '_'), _field_path(field))
+                    for field in by)
+    return _field_path(by)
+
+
+def match(query=None, **kwargs):
+    """
+    :param query: a mongo query dict
+    :param kwargs: field=value equality conditions
+    :return: a $match stage
+    """
+    conditions = dict(query or {})
+    conditions.update(kwargs)
+    return {'$match': conditions}
+
+
+def project(*fields, **expressions):
+    """
+    :param fields: field names to keep
+    :param expressions: computed fields, as aggregation expressions
+    :return: a $project stage
+    """
+    spec = dict((field, 1) for field in fields)
+    spec.update(expressions)
+    return {'$project': spec}
+
+
+def group(by=None, **accumulators):
+    """
+    :param by: the field to group on, a list of fields for a compound key,
+        or None to aggregate every document into one group
+    :param accumulators: output field=accumulator, e.g.
+        total={'$sum': '$amount'}
+    :return: a $group stage
+    """
+    spec = {'_id': _group_key(by)}
+    spec.update(accumulators)
+    return {'$group': spec}
+
+
+def count(by=None, name='count'):
+    """
+    :return: a $group stage counting the documents of each group
+    """
+    return group(by, **{name: {'$sum': 1}})
+
+
+def total(field, by=None, name='total'):
+    """
+    :return: a $group stage summing field over each group
+    """
+    return group(by, **{name: {'$sum': _field_path(field)}})
+
+
+def sort(*keys):
+    """
+    :param keys: field names, prefixed with '-' for descending order
+    :return: a $sort stage
+    """
+    spec = SON()
+    for key in keys:
+        if key.startswith('-'):
+            spec[key[1:]] = DESCENDING
+        else:
+            spec[key] = ASCENDING
+    return {'$sort': spec}
+
+
+def skip(number):
+    return {'$skip': number}
+
+
+def limit(number):
+    return {'$limit': number}
+
+
+def unwind(field):
+    return {'$unwind': _field_path(field)}
+
+
+def aggregate(model, pipeline, batch_size=DEFAULT_BATCH_SIZE,
+              allow_disk_use=False, hydrate=False):
+    """
+    Run an aggregation pipeline on the collection of model, streaming the
+    results one batch at a time
+    :param model: the MongoModel class
+    :param pipeline: a list of stages
+    :param batch_size: the number of documents fetched per round trip
+    :param allow_disk_use: let stages exceeding the server's memory limit
+        write temporary files
+    :param hydrate: yield models built from the output documents, for
+        pipelines of $match, $project, $sort, $skip and $limit stages.
+        Fields left out by a $project are loaded on first access.
+    :return: a generator of documents, or of models if hydrate is set
+    """
+    if isinstance(pipeline, dict):
+        pipeline = [pipeline]
+    pipeline = list(pipeline)
+    if pipeline and '$match' in pipeline[0]:
+        check_query(model, pipeline[0]['$match'])
+    options = {'cursor': {'batchSize': batch_size}}
+    if allow_disk_use:
+        options['allowDiskUse'] = True
+    fields = model._meta['fields']
+    with instrument(model, 'aggregate', pipeline,
+                    streaming=True) as operation:
+        with operation.server():
+            table = MongoConnector.get_table(model)
+            documents = iter(table.aggregate(pipeline, **options))
+        while True:
+            with operation.server():
+                batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            operation.add_documents(batch)
+            if hydrate:
+                with operation.processing():
+                    batch = [model._from_document(document, [
+                        field for field in fields if field not in document]
+                        if '_id' in document else None)
+                        for document in batch]
+            for result in batch:
+                yield result
@@ -0,0 +1,89 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+DEFAULT_WORKERS = 10
+
+_executor = None
+# the process that created _executor; its threads do not survive a fork
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    The process wide executor running the non-blocking API, sized by the
+    MONGO_ASYNC_WORKERS setting.  Its threads share the client's
+    connection pool, so it should not be larger than MONGO_POOL_SIZE.  A
+    forked child process gets an executor of its own.
+    """
+    global _executor, _lock, _pid
+    if _pid != os.getpid():
+        # the executor and lock of the parent are unusable after a fork
+        _executor = None
+        _lock = threading.Lock()
+        _pid = os.getpid()
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(getattr(
+                    settings, 'MONGO_ASYNC_WORKERS', DEFAULT_WORKERS))
+    return _executor
+
+
+def set_executor(executor):
+    global _executor, _pid
+    _executor = executor
+    _pid = os.getpid()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run fn on the executor
+    :return: a concurrent.futures.Future of its result
+    """
+    return get_executor().submit(fn, *args, **kwargs)
+
+
+class AsyncCursor(object):
+    """
+    Streams the models of a QuerySet one batch at a time without blocking
+    the caller.  next_batch() returns a Future of the next list of models,
+    which is empty once the results are exhausted:
+
+        cursor = Model.afind(query)
+        while True:
+            batch = yield cursor.next_batch()
+            if not batch:
+                break
+
+    Batches are fetched one after the other on the executor, so at most one
+    batch is held in memory ahead of the caller.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self._iterator = None
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        with self._lock:
+            if self._iterator is None:
+                self._iterator = self.queryset.iterator()
+            batch = list()
+            for model in self._iterator:
+                batch.append(model)
+                if len(batch) >= self.queryset._batch_size:
+                    break
+            return batch
+
+    def next_batch(self):
+        return submit(self._fetch)
+
+    def to_list(self):
+        """
+        :return: a Future of the list of every matching model
+        """
+        return submit(list, self.queryset)
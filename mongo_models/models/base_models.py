@@ -1,7 +1,204 @@
+import bisect
 import inspect
 
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from connector.instrumentation import instrument
 from connector.models import MongoConnector
-from mongo_models.models import fields as mongo_fields
+from mongo_models.models import aggregation, fields as mongo_fields
+from mongo_models.models.aio import submit
+from mongo_models.models.cache import get_document_cache
+from mongo_models.models.indexes import check_query
+from mongo_models.models.queryset import QuerySet
+from mongo_models.models.session import get_session
+
+
+def _is_id_query(query):
+    return len(query) == 1 and '_id' in query and \
+        not isinstance(query['_id'], dict)
+
+
+def _invalid_value(value, _type):
+    return ValueError("Invalid value: {} for type {}".
+                      format(value, _type.__name__))
+
+
+def _is_overridden(_type, method):
+    return getattr(_type, method).__func__ is not \
+        getattr(mongo_fields.MongoField, method).__func__
+
+
+def _compile_encoder(_type):
+    """
+    Build the function turning a field value into its document value.
+    Returns a tuple of (encode, omit_empty); embedded models and lists are
+    left out of the document when they encode to nothing.
+    """
+    klass = _type.__class__
+    if isinstance(_type, mongo_fields.MongoField):
+        is_valid = klass.is_valid_value
+        if not _is_overridden(klass, 'db_prep'):
+            def encode(value):
+                if not is_valid(value):
+                    raise _invalid_value(value, klass)
+                return value
+        else:
+            db_prep = klass.db_prep
+
+            def encode(value):
+                if not is_valid(value):
+                    raise _invalid_value(value, klass)
+                return db_prep(value)
+        return encode, False
+
+    def encode(value):
+        if value.__class__ is _Unhydrated:
+            value = value.hydrate()
+        if not isinstance(value, klass):
+            raise _invalid_value(value, klass)
+        return value._get_values()
+    return encode, True
+
+
+def _compile_decoder(_type, data_type=None):
+    """
+    Build the function turning a document value into a field value
+    """
+    klass = _type.__class__
+    if isinstance(_type, mongo_fields.MongoField):
+        is_valid = klass.is_valid_value
+        db_parse = klass.db_parse
+        if data_type is not None:
+            def decode(value, set_original):
+                if not is_valid(value):
+                    raise _invalid_value(value, klass)
+                return db_parse(data_type=data_type, value=value)
+        elif not _is_overridden(klass, 'db_parse'):
+            # the base db_parse only re-validates the value
+            def decode(value, set_original):
+                if not is_valid(value):
+                    raise _invalid_value(value, klass)
+                return value
+        else:
+            def decode(value, set_original):
+                if not is_valid(value):
+                    raise _invalid_value(value, klass)
+                return db_parse(value)
+    elif isinstance(_type, MongoList):
+        def build(value):
+            return klass(data_type=data_type)._set_values(
+                value, set_original=True)
+
+        def decode(value, set_original):
+            if set_original:
+                return _Unhydrated(value, build)
+            return klass(data_type=data_type)._set_values(value)
+    elif isinstance(_type, MongoModel):
+        def build(value):
+            return klass()._set_values(value, set_original=True)
+
+        def decode(value, set_original):
+            if set_original:
+                return _Unhydrated(value, build)
+            return klass()._set_values(value)
+    else:
+        def decode(value, set_original):
+            return value
+    return decode
+
+
+def _compile_parser(_type):
+    """
+    Build the function typing a document value for values() and
+    values_list(), or None when the stored value is returned as is.  Unlike
+    the decoders, parsers skip validation and neither resolve related
+    objects nor build embedded models.
+    """
+    klass = _type.__class__
+    if isinstance(_type, mongo_fields.MongoField) and \
+            _is_overridden(klass, 'db_parse') and \
+            not isinstance(_type, mongo_fields.MongoRelatedField):
+        return klass.db_parse
+    return None
+
+
+def _add_change(update, operator, path, value):
+    update.setdefault(operator, dict())[path] = value
+
+
+# marks the value of a field left out by a projection until it is loaded
+_UNLOADED = object()
+
+# marks the value of a field still only held by the stored document of a
+# model loaded with decode on access
+_UNDECODED = object()
+
+
+class _Unhydrated(object):
+    """
+    The stored sub-document of an embedded model or list, kept in place of
+    the field value until the field is first read.  Until then it has no
+    changes to track or save.
+    """
+    __slots__ = ('document', 'build', 'value')
+
+    def __init__(self, document, build):
+        self.document = document
+        self.build = build
+        self.value = None
+
+    def hydrate(self):
+        if self.value is None:
+            self.value = self.build(self.document)
+        return self.value
+
+
+def _compile_default(_type, data_type=None):
+    klass = _type.__class__
+    if isinstance(_type, mongo_fields.MongoField):
+        return lambda: None
+    elif isinstance(_type, MongoList):
+        return lambda: klass(data_type)
+    return klass
+
+
+class FieldDescriptor(object):
+    """
+    Data descriptor installed by MongoMeta for each field.  Values live in
+    a per-instance list indexed by slot, and assigning a field records its
+    original value the first time it changes, so dirty checks only look at
+    the fields that were actually assigned.
+    """
+
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._values[self.slot]
+        if value is _UNDECODED:
+            value = instance._decode_field(self.slot)
+        if value is _UNLOADED:
+            instance._load_deferred()
+            value = instance._values[self.slot]
+        if value.__class__ is _Unhydrated:
+            value = instance._values[self.slot] = value.hydrate()
+        return value
+
+    def __set__(self, instance, value):
+        values = instance._values
+        changed = instance._changed
+        if changed is None:
+            changed = instance._changed = dict()
+        if self.name not in changed:
+            original_value = values[self.slot]
+            if original_value is _UNDECODED:
+                original_value = instance._decode_field(self.slot)
+            changed[self.name] = original_value
+        values[self.slot] = value
 
 
 class MongoMeta(type):
@@ -13,13 +210,42 @@ class MongoMeta(type):
         for base in bases:
             if hasattr(base, '_meta'):
                 fields.update(base._meta.get('fields'))
+                sub_meta.update(base._meta.get('fields_meta'))
         for member in self._get_attrs_with_types(attributes, bases):
             attr, _type = member
             fields[attr] = _type
             if hasattr(_type, 'data_type'):
                 sub_meta[attr] = dict()
                 sub_meta[attr]['data_type'] = getattr(_type, 'data_type')
-            delattr(self, attr)
+        self._compile_serializers()
+
+    def _compile_serializers(self):
+        """
+        Resolve the per-field type dispatch once per class, so encoding and
+        decoding documents is a walk over prebuilt function tables.  The
+        tables are ordered by slot, the index of each field's value in the
+        instance storage.
+        """
+        slots = self._meta['slots'] = dict()
+        embedded = self._meta['embedded'] = list()
+        encoders = self._meta['encoders'] = list()
+        decoders = self._meta['decoders'] = list()
+        defaults = self._meta['defaults'] = list()
+        parsers = self._meta['parsers'] = dict()
+        for slot, (field, _type) in enumerate(self._meta['fields'].items()):
+            data_type = self._meta['fields_meta'].get(field, {}).\
+                get('data_type')
+            slots[field] = slot
+            if not isinstance(_type, mongo_fields.MongoField):
+                embedded.append((field, slot))
+            encode, omit_empty = _compile_encoder(_type)
+            encoders.append((field, encode, omit_empty))
+            decoders.append((field, _compile_decoder(_type, data_type)))
+            defaults.append((field, _compile_default(_type, data_type)))
+            parser = _compile_parser(_type)
+            if parser is not None:
+                parsers[field] = parser
+            setattr(self, field, FieldDescriptor(field, slot))
 
     def _get_attrs_with_types(self, attrs, bases):
         attributes = list()
@@ -38,82 +264,175 @@ class MongoModel(object):
     _id = mongo_fields.MongoIdField()
     __metaclass__ = MongoMeta
     _unique_on = None
+    _cache_documents = False
+    _cache_timeout = None
+    _decode_on_access = False
+    _collection_name = None
+    _read_preference = None
+    _write_concern = None
+    _indexes = None
 
     def __init__(self, *args, **kwargs):
-        attrs_types = [(a, self._meta['fields'][a])
-                       for a in self._meta['fields']]
-        for attr in attrs_types:
-            attr, _type = attr
-            if kwargs.get(attr) is not None:
-                if issubclass(_type.__class__, MongoModel):
-                    values = kwargs.get(attr)
-                    if isinstance(values, _type.__class__):
-                        setattr(self, attr, values)
-                    else:
-                        setattr(self, attr,
-                                _type.__class__()._set_values(values))
-                else:
-                    setattr(self, attr, kwargs[attr])
+        fields = self._meta['fields']
+        values = self._values = list()
+        self._changed = None
+        for attr, default in self._meta['defaults']:
+            value = kwargs.get(attr)
+            if value is not None:
+                _type = fields[attr]
+                if issubclass(_type.__class__, MongoModel) and \
+                        not isinstance(value, _type.__class__):
+                    value = _type.__class__()._set_values(value)
+                values.append(value)
             else:
-                if issubclass(_type.__class__, mongo_fields.MongoField):
-                    setattr(self, attr, None)
-                elif isinstance(_type, MongoList):
-                    setattr(self, attr, _type.__class__(
-                        self._meta['fields_meta'][attr]['data_type']))
-                else:
-                    setattr(self, attr, _type.__class__())
+                values.append(default())
         if self._unique_on:
             query = self._build_query(self._unique_on)
             if query:
                 self.set(query)
-        self._original_values = dict()
-        for attr in attrs_types:
-            attr, _type = attr
-            self._original_values[attr] = getattr(self, attr)
+                self._changed = None
         super(MongoModel, self).__init__()
 
+    def _get_original_values(self):
+        """
+        The values of the model as last stored or loaded, before its pending
+        changes; fields assigned while deferred are left out
+        """
+        values = self._get_values() or dict()
+        changed = self._changed or {}
+        encoders = self._meta['encoders']
+        slots = self._meta['slots']
+        for field, original in changed.items():
+            slot = slots[field]
+            if original.__class__ is _Unhydrated:
+                value = original.document
+            elif original is None or original is _UNLOADED:
+                value = None
+            elif isinstance(original, MongoModel):
+                value = original._get_original_values()
+            else:
+                value = encoders[slot][1](original)
+            if value or (value is not None and not encoders[slot][2]):
+                values[field] = value
+            else:
+                values.pop(field, None)
+        for field, slot in self._meta['embedded']:
+            value = self._values[slot]
+            if field not in changed and isinstance(value, MongoModel):
+                value = value._get_original_values()
+                if value:
+                    values[field] = value
+                else:
+                    values.pop(field, None)
+        return values or None
+
     def reset_state(self):
-        attrs_types = [(a, self._meta['fields'][a])
-                       for a in self._meta['fields']]
-        self._original_values = dict()
-        for attr in attrs_types:
-            attr, _type = attr
-            value = getattr(self, attr)
+        self._changed = None
+        values = self._values
+        for field, slot in self._meta['embedded']:
+            value = values[slot]
             if isinstance(value, MongoModel):
                 value.reset_state()
-            self._original_values[attr] = value
 
     def get_dirty_fields(self):
         dirty_fields = dict()
-        for attribute in self._meta['fields']:
-            if isinstance(self._meta['fields'][attribute],
-                          mongo_fields.MongoField):
-                value = self._meta['fields'][attribute].db_prep(
-                    getattr(self, attribute))
-                original_value = self._meta['fields'][attribute].db_prep(
-                    self._original_values[attribute])
-                if isinstance(value, dict) and \
-                        isinstance(original_value, dict) and \
-                        value != original_value:
-                    for val in original_value:
-                        if dirty_fields.get(attribute) is None:
-                            dirty_fields[attribute] = dict()
-                        dirty_fields[attribute][val] = original_value[val]
-                elif (value is not None or original_value is not None) and \
-                        value != original_value:
-                    dirty_fields[attribute] = original_value
-            elif isinstance(self._meta['fields'][attribute], MongoModel):
-                if getattr(self, attribute) is not None:
-                    sub_dirty_fields = \
-                        getattr(self, attribute).get_dirty_fields()
-                    for sub in sub_dirty_fields:
-                        if dirty_fields.get(attribute) is None:
-                            dirty_fields[attribute] = dict()
-                        dirty_fields[attribute][sub] = sub_dirty_fields[sub]
-                elif self._original_values.get(attribute) is not None:
-                    dirty_fields[attribute] = self._original_values[attribute]
+        fields = self._meta['fields']
+        slots = self._meta['slots']
+        values = self._values
+        changed = self._changed or {}
+        for attribute, original_value in changed.items():
+            _type = fields[attribute]
+            if not isinstance(_type, mongo_fields.MongoField):
+                continue
+            if original_value is _UNLOADED:
+                original_value = None
+            value = _type.db_prep(values[slots[attribute]])
+            original_value = _type.db_prep(original_value)
+            if isinstance(value, dict) and \
+                    isinstance(original_value, dict) and \
+                    value != original_value:
+                for val in original_value:
+                    if dirty_fields.get(attribute) is None:
+                        dirty_fields[attribute] = dict()
+                    dirty_fields[attribute][val] = original_value[val]
+            elif (value is not None or original_value is not None) and \
+                    value != original_value:
+                dirty_fields[attribute] = original_value
+        for attribute, slot in self._meta['embedded']:
+            value = values[slot]
+            if value is _UNLOADED or value is _UNDECODED or \
+                    value.__class__ is _Unhydrated:
+                # deferred or never read, so unchanged
+                continue
+            if value is not None:
+                sub_dirty_fields = value.get_dirty_fields()
+                for sub in sub_dirty_fields:
+                    if dirty_fields.get(attribute) is None:
+                        dirty_fields[attribute] = dict()
+                    dirty_fields[attribute][sub] = sub_dirty_fields[sub]
+            elif changed.get(attribute) not in (None, _UNLOADED):
+                original_value = changed[attribute]
+                if original_value.__class__ is _Unhydrated:
+                    original_value = original_value.hydrate()
+                dirty_fields[attribute] = original_value
         return dirty_fields
 
+    def _get_changes(self, update, prefix=''):
+        """
+        Add the changes made since the last reset_state to an update
+        document as dotted paths; embedded models are diffed field by field
+        and lists send their own change log
+        :param update: the update document to fill
+        :param prefix: the dotted path of this model within its document
+        """
+        fields = self._meta['fields']
+        slots = self._meta['slots']
+        encoders = self._meta['encoders']
+        values = self._values
+        changed = self._changed or {}
+        for field, original_value in changed.items():
+            _type = fields[field]
+            if field == '_id' or \
+                    not isinstance(_type, mongo_fields.MongoField):
+                continue
+            path = prefix + field
+            slot = slots[field]
+            value = values[slot]
+            if value is None:
+                if original_value is not None:
+                    _add_change(update, '$unset', path, '')
+                continue
+            value = encoders[slot][1](value)
+            if original_value is None or original_value is _UNLOADED or \
+                    value != _type.db_prep(original_value):
+                _add_change(update, '$set', path, value)
+        for field, slot in self._meta['embedded']:
+            path = prefix + field
+            value = values[slot]
+            if value is _UNLOADED or value is _UNDECODED or \
+                    value.__class__ is _Unhydrated:
+                continue
+            original_value = changed.get(field, value)
+            if value is None:
+                if original_value is not None:
+                    _add_change(update, '$unset', path, '')
+            elif value is original_value:
+                value._get_changes(update, prefix=path + '.')
+            else:
+                value = encoders[slot][1](value)
+                if value:
+                    _add_change(update, '$set', path, value)
+                else:
+                    _add_change(update, '$unset', path, '')
+
+    def _get_update(self):
+        """
+        :return: an update document, empty if nothing changed
+        """
+        update = dict()
+        self._get_changes(update)
+        return update
+
     def _build_query(self, unique_on=None, all_fields=False):
         query = dict()
         fields = unique_on
@@ -148,149 +467,462 @@ class MongoModel(object):
         members = inspect.getmembers(cls)
         attributes = [a[0] for a in members if not a[0].startswith('_') and
                       not inspect.isroutine(a[1]) and
-                      not inspect.isfunction(a[1])]
+                      not inspect.isfunction(a[1]) and
+                      not isinstance(a[1], FieldDescriptor)]
         return attributes
 
     def _get_values(self):
-        fields = self._meta['fields']
+        attributes = self._values
         values = dict()
-        for field in fields:
-            _type = fields[field].__class__
-            value = getattr(self, field)
-            if value is not None:
-                if issubclass(_type, mongo_fields.MongoField):
-                    is_valid = _type.is_valid_value(value)
-                    if is_valid:
-                        values[field] = _type.db_prep(value)
-                    else:
-                        raise ValueError(
-                            "Invalid value: {} for type {}".
-                            format(value, _type.__name__))
-                elif issubclass(_type, MongoModel):
-                    if not isinstance(value, _type):
-                        raise ValueError(
-                            "Invalid value: {} for type {}".
-                            format(value, _type.__name__))
-                    value = value._get_values()
-                    if value:
-                        values[field] = value
+        for slot, (field, encode, omit_empty) in \
+                enumerate(self._meta['encoders']):
+            value = attributes[slot]
+            if value is _UNDECODED:
+                # never read, so passed back as stored
+                value = self._document.get(field)
+                if value is None:
+                    continue
+            elif value is None or value is _UNLOADED:
+                continue
+            else:
+                value = encode(value)
+            if value or not omit_empty:
+                values[field] = value
         return values or None
 
     def _set_values(self, values, set_original=False):
-        fields = self._meta['fields']
         if values:
-            for field in fields:
-                _type = fields[field].__class__
+            attributes = self._values
+            for slot, (field, decode) in enumerate(self._meta['decoders']):
                 value = values.get(field)
                 if value is not None:
-                    if issubclass(_type, mongo_fields.MongoField):
-                        is_valid = _type.is_valid_value(value)
-                        if is_valid:
-                            if self._meta['fields_meta'].get(field) and \
-                                    self._meta['fields_meta'].get(field).\
-                                    get('data_type'):
-                                setattr(self, field, _type.db_parse(
-                                    data_type=self._meta['fields_meta'][field]
-                                    ['data_type'], value=value))
-                            else:
-                                setattr(self, field, _type.db_parse(value))
-                        else:
-                            raise ValueError(
-                                "Invalid value: {} for type {}".
-                                format(value, _type.__name__))
-                    elif issubclass(_type, MongoModel):
-                        if issubclass(_type, MongoList):
-                            setattr(self, field, _type(
-                                data_type=self._meta['fields_meta'][field]
-                                ['data_type'])._set_values(
-                                    value, set_original=set_original))
-                        else:
-                            setattr(self, field,
-                                    _type._set_values(
-                                        _type(), value,
-                                        set_original=set_original))
+                    if set_original:
+                        attributes[slot] = decode(value, True)
                     else:
-                        setattr(self, field, value)
+                        setattr(self, field, decode(value, False))
         if set_original:
-            for field in fields:
-                self._original_values[field] = getattr(self, field)
+            self._changed = None
         return self
 
+    def _is_new(self):
+        """
+        Whether the model has not been stored yet: it has no _id, or its
+        _id was assigned by the client since it was created or loaded
+        """
+        return self._id is None or (self._changed is not None and
+                                    self._changed.get('_id', False) is None)
+
     def save(self, **kwargs):
         """
-        Save object if it has at least one value set
+        Save object if it has at least one value set.  New objects are
+        inserted whole (upserted by _id when the client assigned one);
+        existing ones only send their changed fields.
         :param kwargs:
         :return:
         """
         try:
-            if self._id is None or self.get_dirty_fields():
-                values = self._get_values()
-                table = MongoConnector.get_table(self)
-                self._id = table.save(values)
+            if self._is_new():
+                with instrument(self, 'insert') as operation:
+                    with operation.processing():
+                        values = self._get_values()
+                    table = MongoConnector.get_table(self)
+                    with operation.server():
+                        self._id = table.save(values)
+                    operation.add_documents([values])
+                self._invalidate_cache()
                 self.reset_state()
+                session = get_session()
+                if session is not None:
+                    session.add(self)
+            else:
+                with instrument(self, 'update') as operation:
+                    with operation.processing():
+                        update = self._get_update()
+                    if update:
+                        table = MongoConnector.get_table(self)
+                        with operation.server():
+                            table.update({'_id': self._id}, update)
+                        operation.add_documents([update])
+                if update:
+                    self._invalidate_cache()
+                    self.reset_state()
             if hasattr(self, 'post_save'):
                 self.post_save(**kwargs)
         except TypeError as e:
             if e.message != "cannot save object of type <type 'NoneType'>":
                 raise e
 
+    @classmethod
+    def save_many(cls, models, ordered=False, batch_size=1000, **kwargs):
+        """
+        Save many models with chunked bulk writes: new models are inserted
+        whole and existing ones send their partial updates.  Models that
+        were written get their _id and reset state even if other writes in
+        the batch fail, in which case the BulkWriteError is re-raised.
+        :param models: an iterable of instances of this class
+        :param ordered: stop at the first failing write
+        :param batch_size: the number of operations per bulk write
+        :param kwargs: passed on to post_save
+        :return:
+        """
+        table = MongoConnector.get_table(cls)
+        operations = list()
+        with instrument(cls, 'save_many') as operation:
+            for model in models:
+                if model.__class__ is not cls:
+                    raise ValueError("Cannot save {} with {}.save_many".
+                                     format(model, cls.__name__))
+                with operation.processing():
+                    if model._is_new():
+                        values = model._get_values()
+                        if values is None:
+                            continue
+                        if values.get('_id') is None:
+                            values['_id'] = ObjectId()
+                        operations.append((model, values, None))
+                    else:
+                        update = model._get_update()
+                        if update:
+                            operations.append((model, None, update))
+                if len(operations) >= batch_size:
+                    cls._instrumented_bulk_write(
+                        operation, table, operations, ordered, **kwargs)
+                    operations = list()
+            if operations:
+                cls._instrumented_bulk_write(
+                    operation, table, operations, ordered, **kwargs)
+
+    @classmethod
+    def _instrumented_bulk_write(cls, operation, table, operations, ordered,
+                                 **kwargs):
+        operation.add_documents(values or update
+                                for model, values, update in operations)
+        with operation.server():
+            cls._bulk_write(table, operations, ordered, **kwargs)
+
+    @classmethod
+    def _bulk_write(cls, table, operations, ordered, **kwargs):
+        if ordered:
+            bulk = table.initialize_ordered_bulk_op()
+        else:
+            bulk = table.initialize_unordered_bulk_op()
+        for model, values, update in operations:
+            if values is not None and model._id is not None:
+                # a client assigned _id, saved like save() does
+                bulk.find({'_id': values['_id']}).upsert().\
+                    replace_one(values)
+            elif values is not None:
+                bulk.insert(values)
+            else:
+                bulk.find({'_id': model._id}).update_one(update)
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            cls._invalidate_cache()
+            failed = set(error['index']
+                         for error in e.details.get('writeErrors', []))
+            if ordered and failed:
+                failed = set(range(min(failed), len(operations)))
+            cls._bulk_saved(operations, failed, **kwargs)
+            raise
+        cls._invalidate_cache()
+        cls._bulk_saved(operations, set(), **kwargs)
+
+    @staticmethod
+    def _bulk_saved(operations, failed, **kwargs):
+        for index, (model, values, update) in enumerate(operations):
+            if index in failed:
+                continue
+            if values is not None:
+                model._id = values['_id']
+            model.reset_state()
+            if hasattr(model, 'post_save'):
+                model.post_save(**kwargs)
+
     def set(self, query, set_original=False):
-        table = MongoConnector.get_table(self.__class__)
-        results = table.find(query)
-        if results.count() > 1:
-            raise ValueError("Multiple results returned for query {}".
-                             format(query))
-        elif results.count() == 1:
-            self._set_values(results[0], set_original=set_original)
+        result = self._find_unique(query)
+        if result is not None:
+            self._set_values(result, set_original=set_original)
 
     @classmethod
     def get(cls, query):
+        session = get_session()
+        if session is not None and _is_id_query(query):
+            model = session.get(cls, query['_id'])
+            if model is not None:
+                return model
+        with instrument(cls, 'get', query) as operation:
+            with operation.server():
+                result = cls._find_unique(query)
+            if result is not None:
+                operation.add_documents([result])
+                with operation.processing():
+                    return cls._from_document(result)
+        return None
+
+    @classmethod
+    def get_by_id(cls, _id):
+        """
+        Fast path for primary key lookups
+        :param _id: an ObjectId or its string representation
+        :return: the model, or None if there is no such document
+        """
+        if not isinstance(_id, ObjectId):
+            if not ObjectId.is_valid(_id):
+                return None
+            _id = ObjectId(_id)
+        return cls.get({'_id': _id})
+
+    @classmethod
+    def _find_unique(cls, query):
+        """
+        Fetch the single document matching the query, through the document
+        cache if the model enables it with _cache_documents
+        :param query: a mongo query dict
+        :return: the raw document or None
+        """
+        if cls._cache_documents:
+            return get_document_cache().get(
+                MongoConnector.get_table_name(cls), query,
+                lambda: cls._fetch_unique(query), cls._cache_timeout)
+        return cls._fetch_unique(query)
+
+    @classmethod
+    def _fetch_unique(cls, query):
+        """
+        Fetch the single document matching the query in one round trip;
+        limit(2) is enough to tell a unique match from a duplicate.
+        :param query: a mongo query dict
+        :return: the raw document or None
+        """
         table = MongoConnector.get_table(cls)
-        results = table.find(query)
-        if results.count() > 1:
+        if _is_id_query(query):
+            return table.find_one(query)
+        check_query(cls, query)
+        results = list(table.find(query).limit(2))
+        if len(results) > 1:
             raise ValueError("Multiple results returned for query {}".
                              format(query))
-        elif results.count() == 1:
-            return cls()._set_values(results[0], set_original=True)
-        else:
-            return None
+        elif results:
+            return results[0]
+        return None
 
     @classmethod
-    def find(cls, query):
-        table = MongoConnector.get_table(cls)
-        results = table.find(query)
-        if results.count() > 0:
-            models = list()
-            for result in results:
-                model = cls()._set_values(result, set_original=True)
-                models.append(model)
-            return models
+    def find(cls, query=None):
+        """
+        Lazily query the collection; the server is only hit when the
+        returned QuerySet is iterated.  An empty QuerySet is falsy.
+        :param query: a mongo query dict
+        :return: QuerySet
+        """
+        return QuerySet(cls, query)
+
+    @classmethod
+    def paginate(cls, query=None, page_size=QuerySet.DEFAULT_PAGE_SIZE,
+                 after=None):
+        """
+        Fetch a page of the matching models in _id order; see
+        QuerySet.paginate
+        :param after: the next_token of the previous page
+        :return: a Page
+        """
+        return cls.find(query).paginate(page_size, after)
+
+    @classmethod
+    def scan(cls, query=None, page_size=QuerySet.DEFAULT_PAGE_SIZE,
+             after=None):
+        """
+        Walk the matching models in _id order one page at a time; see
+        QuerySet.scan
+        :return: a generator of Pages
+        """
+        return cls.find(query).scan(page_size, after)
+
+    @classmethod
+    def aggregate(cls, pipeline, batch_size=aggregation.DEFAULT_BATCH_SIZE,
+                  allow_disk_use=False, hydrate=False):
+        """
+        Run an aggregation pipeline on the server, streaming its results in
+        batches; see mongo_models.models.aggregation for stage helpers
+        :param pipeline: a list of stages
+        :param batch_size: the number of documents fetched per round trip
+        :param allow_disk_use: let large stages spill to disk on the server
+        :param hydrate: yield models instead of raw documents
+        :return: a generator of the resulting documents or models
+        """
+        return aggregation.aggregate(cls, pipeline, batch_size,
+                                     allow_disk_use, hydrate)
+
+    @classmethod
+    def _from_document(cls, document, deferred=None, decode_on_access=None):
+        """
+        :param document: a raw document
+        :param deferred: names of fields left out of the document by a
+            projection; they are loaded on first access
+        :param decode_on_access: keep the document and decode each field
+            the first time it is read; defaults to _decode_on_access
+        :return: the model
+        """
+        session = get_session()
+        if session is None or document.get('_id') is None:
+            return cls._load(document, deferred, decode_on_access)
+        model = session.get(cls, document['_id'])
+        if model is None:
+            model = cls._load(document, deferred, decode_on_access)
+            session.add(model)
+        return model
+
+    @classmethod
+    def _load(cls, document, deferred, decode_on_access):
+        if decode_on_access is None:
+            decode_on_access = cls._decode_on_access
+        if not decode_on_access:
+            return cls()._set_values(document, set_original=True).\
+                _defer(deferred)
+        model = cls.__new__(cls)
+        model._values = [_UNDECODED] * len(cls._meta['decoders'])
+        model._document = document
+        model._changed = None
+        return model._defer(deferred)
+
+    def _decode_field(self, slot):
+        """
+        Decode the value of a field from the stored document of a model
+        loaded with decode on access
+        """
+        field, decode = self._meta['decoders'][slot]
+        value = self._document.get(field)
+        if value is None:
+            value = self._meta['defaults'][slot][1]()
         else:
-            return None
+            value = decode(value, True)
+        self._values[slot] = value
+        return value
+
+    def _defer(self, fields):
+        if fields:
+            slots = self._meta['slots']
+            for field in fields:
+                self._values[slots[field]] = _UNLOADED
+            if self._changed:
+                for field in fields:
+                    self._changed.pop(field, None)
+        return self
+
+    def _unloaded_fields(self):
+        """
+        :return: the deferred fields that were not loaded or assigned yet
+        """
+        values = self._values
+        return [field for slot, (field, decode) in
+                enumerate(self._meta['decoders'])
+                if values[slot] is _UNLOADED]
+
+    def _load_deferred(self):
+        """
+        Load every deferred field that has not been loaded or assigned yet,
+        in a single round trip
+        """
+        fields = self._unloaded_fields()
+        if not fields:
+            return
+        table = MongoConnector.get_table(self)
+        with instrument(self, 'load_deferred') as operation:
+            with operation.server():
+                document = table.find_one({'_id': self._id}, fields) or {}
+            operation.add_documents([document])
+            with operation.processing():
+                values = self._values
+                slots = self._meta['slots']
+                for field, default in self._meta['defaults']:
+                    if field in fields:
+                        values[slots[field]] = default()
+                for field, decode in self._meta['decoders']:
+                    if field in fields:
+                        value = document.get(field)
+                        if value is not None:
+                            values[slots[field]] = decode(value, True)
 
     def remove(self):
+        session = get_session()
+        if session is not None:
+            session.discard(self)
         self.delete({'_id': self._id})
 
     @classmethod
     def delete(cls, query):
         table = MongoConnector.get_table(cls)
-        table.remove(query)
+        with instrument(cls, 'delete', query) as operation:
+            with operation.server():
+                table.remove(query)
+        cls._invalidate_cache()
 
     @classmethod
     def delete_one(cls, query):
         table = MongoConnector.get_table(cls)
-        table.remove(query, multi=False)
+        with instrument(cls, 'delete_one', query) as operation:
+            with operation.server():
+                table.remove(query, multi=False)
+        cls._invalidate_cache()
+
+    # The non-blocking API runs the methods above on the executor of
+    # mongo_models.models.aio and returns Futures of their results.  The
+    # executor threads do not see the caller's Session.
+
+    @classmethod
+    def aget(cls, query):
+        return submit(cls.get, query)
+
+    @classmethod
+    def aget_by_id(cls, _id):
+        return submit(cls.get_by_id, _id)
+
+    @classmethod
+    def afind(cls, query=None):
+        """
+        :return: an AsyncCursor streaming the matching models in batches
+        """
+        return cls.find(query).aiterator()
+
+    def asave(self, **kwargs):
+        return submit(self.save, **kwargs)
+
+    @classmethod
+    def asave_many(cls, models, ordered=False, batch_size=1000, **kwargs):
+        return submit(cls.save_many, list(models), ordered=ordered,
+                      batch_size=batch_size, **kwargs)
+
+    def aremove(self):
+        return submit(self.remove)
+
+    @classmethod
+    def adelete(cls, query):
+        return submit(cls.delete, query)
+
+    @classmethod
+    def _invalidate_cache(cls):
+        if cls._cache_documents:
+            get_document_cache().invalidate(
+                MongoConnector.get_table_name(cls))
 
     def clone(self, **kwargs):
-        attributes = self.__dict__.copy()
-        if attributes.get('_id'):
-            del attributes['_id']
+        self._load_deferred()
+        attributes = dict((field, getattr(self, field)) for field in
+                          self._meta['slots'] if field != '_id')
         attributes.update(kwargs)
         clone = self.__class__(**attributes)
         return clone
 
 
 class MongoList(list, MongoModel):
+    """
+    A list field keeping a log of the changes made since the last
+    reset_state, keyed by the original index of each item, so saving it
+    sends $push, $pull or positional $set operations instead of the whole
+    array.  Changes that cannot be expressed in one update without
+    conflicting paths (e.g. an append and a delete) rewrite the array.
+    """
+
     def __init__(self, data_type, **kwargs):
         if not data_type and not hasattr(data_type, '__module__'):
             raise ValueError("Must declare a class type when creating a "
@@ -299,61 +931,209 @@ class MongoList(list, MongoModel):
         self.data_type = data_type
         self.reset_state()
 
-    def append(self, obj):
+    def _check(self, obj):
         if not isinstance(obj, self.data_type):
             raise ValueError(
                 "Invalid object added to list: expecting {}, received {}".
-                format(self.model, type(obj)))
+                format(self.data_type, type(obj)))
+
+    def append(self, obj):
+        self._check(obj)
         super(MongoList, self).append(obj)
 
+    def extend(self, iterable):
+        for obj in iterable:
+            self.append(obj)
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def insert(self, index, obj):
+        self._check(obj)
+        if index < 0:
+            index = max(len(self) + index, 0)
+        if index < self._kept():
+            self._rewrite = True
+        super(MongoList, self).insert(index, obj)
+
+    def pop(self, index=-1):
+        value = self[index]
+        del self[index]
+        return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def sort(self, *args, **kwargs):
+        self._rewrite = True
+        super(MongoList, self).sort(*args, **kwargs)
+
+    def reverse(self):
+        self._rewrite = True
+        super(MongoList, self).reverse()
+
     def reset_state(self):
-        self._original_values = list(self)
-        self._deleted_values = list()
+        self._length = len(self)
+        self._replaced = dict()
+        self._deleted = dict()
+        self._deleted_indexes = list()
+        self._rewrite = False
+        if issubclass(self.data_type, MongoModel):
+            for item in self:
+                item.reset_state()
+
+    def _kept(self):
+        """
+        :return: the number of original items still in the list; they come
+            before any appended item
+        """
+        return self._length - len(self._deleted)
+
+    def _original_index(self, index):
+        """
+        Map the current index of an original item to its index at the last
+        reset_state, skipping over the deleted ones
+        """
+        deleted = self._deleted_indexes
+        original = index
+        while True:
+            shifted = index + bisect.bisect_right(deleted, original)
+            if shifted == original:
+                return original
+            original = shifted
+
+    @staticmethod
+    def _encode_item(item):
+        if isinstance(item, MongoModel):
+            return item._get_values()
+        return item.__str__()
+
+    @staticmethod
+    def _original_item(item):
+        if isinstance(item, MongoModel):
+            return item._get_original_values()
+        return item
+
+    def _get_original_values(self):
+        """
+        The items as last stored or loaded, or as they are now once the list
+        was reordered or sliced
+        """
+        if self._rewrite:
+            return self._get_values()
+        items = list()
+        deleted = self._deleted_indexes
+        for original in range(self._length):
+            if original in self._deleted:
+                item = self._deleted[original]
+            elif original in self._replaced:
+                item = self._replaced[original]
+            else:
+                item = self[original - bisect.bisect_left(deleted, original)]
+            items.append(self._original_item(item))
+        return items
 
     def get_dirty_fields(self):
         """
-        If the objects are MongoModels, the fields of each object need to be
-        retrieved, otherwise, the __setitem__ will set the appropriate dirty
-        field
+        Map the original index of each replaced or deleted item to its
+        original value, the index of each embedded model changed in place
+        to its dirty fields, and the index of each appended item to the item
         :return: a dictionary of dirty fields mapped to original values
         """
+        if self._rewrite:
+            return dict(enumerate(self))
         dirty_fields = dict()
-        cur_self_iterator = 0
-        for i, items in enumerate(self._original_values):
-            if issubclass(self.data_type, MongoModel):
-                if i in self._deleted_values:
-                    dirty_field = self._original_values[i]._get_values()
-                    for field in dirty_field:
-                        if dirty_fields.get(i) is None:
-                            dirty_fields[i] = dict()
-                        dirty_fields[i][field] = dirty_field[field]
-                elif self[cur_self_iterator].get_dirty_fields() or \
-                        self[cur_self_iterator] != self._original_values[i]:
-                    dirty_field = self[cur_self_iterator].get_dirty_fields()
-                    for field in dirty_field:
-                        if dirty_fields.get(i) is None:
-                            dirty_fields[i] = dict()
-                        dirty_fields[i][field] = dirty_field[field]
-            else:
-                dirty_fields[i] = self._original_values[i]
-            if i not in self._deleted_values:
-                cur_self_iterator += 1
-        if cur_self_iterator < len(self):
-            end = len(self)
-            while cur_self_iterator < end:
-                dirty_fields[cur_self_iterator] = self[cur_self_iterator]
-                cur_self_iterator += 1
+        for index, item in self._deleted.items():
+            dirty_fields[index] = self._original_item(item)
+        for index, item in self._replaced.items():
+            dirty_fields[index] = self._original_item(item)
+        kept = self._kept()
+        if issubclass(self.data_type, MongoModel):
+            for index in range(kept):
+                original = self._original_index(index)
+                if original not in self._replaced:
+                    dirty_field = self[index].get_dirty_fields()
+                    if dirty_field:
+                        dirty_fields[original] = dirty_field
+        for index in range(kept, len(self)):
+            dirty_fields[index] = self[index]
         return dirty_fields
 
+    def _get_changes(self, update, prefix=''):
+        """
+        Add the change log to an update document
+        :param update: the update document to fill
+        :param prefix: the dotted path of this list within its document
+        """
+        path = prefix[:-1]
+        if self._rewrite:
+            return self._rewrite_changes(update, path)
+        kept = self._kept()
+        nested = dict()
+        if issubclass(self.data_type, MongoModel):
+            # collected even alongside deletes, which then rewrite the list
+            # so that these changes are not lost
+            for index in range(kept):
+                if self._original_index(index) not in self._replaced:
+                    self[index]._get_changes(
+                        nested, prefix='{}{}.'.format(prefix, index))
+        appended = self[kept:]
+        if self._deleted:
+            pull = None
+            if not (appended or self._replaced or nested):
+                pull = self._pull_condition()
+            if pull is None:
+                return self._rewrite_changes(update, path)
+            _add_change(update, '$pull', path, pull)
+        elif appended:
+            if self._replaced or nested:
+                return self._rewrite_changes(update, path)
+            _add_change(update, '$push', path, {
+                '$each': [self._encode_item(item) for item in appended]})
+        else:
+            for index in self._replaced:
+                _add_change(update, '$set', '{}{}'.format(prefix, index),
+                            self._encode_item(self[index]))
+            for operator, changes in nested.items():
+                update.setdefault(operator, dict()).update(changes)
+
+    def _rewrite_changes(self, update, path):
+        values = self._get_values()
+        if values:
+            _add_change(update, '$set', path, values)
+        else:
+            _add_change(update, '$unset', path, '')
+
+    def _pull_condition(self):
+        """
+        :return: a $pull condition removing exactly the deleted items, or
+            None if it would also match items still in the list
+        """
+        deleted = [self._encode_item(item) for item in self._deleted.values()]
+        if issubclass(self.data_type, MongoModel):
+            # documents are matched field by field, so only pull a single
+            # one that no remaining document contains, and that was not
+            # changed in place before being deleted
+            if len(deleted) > 1 or not deleted[0]:
+                return None
+            for item in self._deleted.values():
+                if item.get_dirty_fields():
+                    return None
+            condition = deleted[0]
+            for item in self:
+                values = item._get_values() or {}
+                if all(values.get(key) == value
+                       for key, value in condition.items()):
+                    return None
+            return condition
+        remaining = set(self._encode_item(item) for item in self)
+        if remaining.intersection(deleted):
+            return None
+        return {'$in': deleted}
+
     def _get_values(self):
-        values = list()
-        for d in self:
-            if isinstance(d, object) and hasattr(d, '__class__') and \
-                    issubclass(d.__class__, MongoModel):
-                values.append(d._get_values())
-            else:
-                values.append(d.__str__())
-        return values
+        return [self._encode_item(item) for item in self]
 
     def _set_values(self, values, set_original=False):
         for value in values:
@@ -372,16 +1152,54 @@ class MongoList(list, MongoModel):
             self.reset_state()
         return self
 
-    def __delitem__(self, y):
-        offset = 0
-        for i in self._deleted_values:
-            if y >= i:
-                offset += 1
-        self._deleted_values.append(y + offset)
-        super(MongoList, self).__delitem__(y)
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._rewrite = True
+        else:
+            self._check(value)
+            if index < 0:
+                index += len(self)
+            if index < self._kept():
+                original = self._original_index(index)
+                if original not in self._replaced:
+                    self._replaced[original] = self[index]
+        super(MongoList, self).__setitem__(index, value)
+
+    def __setslice__(self, i, j, sequence):
+        self._rewrite = True
+        super(MongoList, self).__setslice__(i, j, sequence)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for i in reversed(range(*index.indices(len(self)))):
+                del self[i]
+            return
+        if index < 0:
+            index += len(self)
+        if index < self._kept():
+            original = self._original_index(index)
+            item = self._replaced.pop(original, self[index])
+            self._deleted[original] = item
+            bisect.insort(self._deleted_indexes, original)
+        super(MongoList, self).__delitem__(index)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
 
     def __getattribute__(self, name):
         if name.isdigit():
             return self[int(name)]
         else:
             return super(MongoList, self).__getattribute__(name)
+
+
+def get_models(klass=MongoModel):
+    """
+    :return: every subclass of klass defined so far, except MongoList
+    """
+    models = list()
+    for subclass in klass.__subclasses__():
+        if subclass is not MongoList:
+            models.append(subclass)
+            models.extend(get_models(subclass))
+    return models
@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from bson import BSON, json_util
+from django.conf import settings
+
+DEFAULT_MAX_SIZE = 10000
+
+_MISSING = '__missing__'
+
+
+class LRUCache(object):
+    """
+    In-process cache backend with a size bound and per-entry timeouts
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheBackend(object):
+    """
+    Cache backend storing documents in one of Django's configured caches,
+    so entries are shared between processes
+    """
+
+    def __init__(self, alias='default'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.evictions = 0
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class DocumentCache(object):
+    """
+    Read-through cache of raw documents keyed by collection and normalized
+    query.  Documents are stored BSON encoded, so callers never share
+    mutable state with the cache.  Every write to a collection gives it a
+    new generation, which orphans all of its cached entries at once without
+    having to know which queries a write affected; orphaned entries age out
+    of the backend.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else LRUCache()
+        self.hits = 0
+        self.misses = 0
+
+    def _generation(self, collection):
+        key = 'generation:{}'.format(collection)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = self.invalidate(collection)
+        return generation
+
+    def _key(self, collection, query):
+        query = json_util.dumps(query, sort_keys=True)
+        return 'document:{}:{}:{}'.format(
+            collection, self._generation(collection),
+            hashlib.md5(query.encode('utf-8')).hexdigest())
+
+    def get(self, collection, query, fetch, timeout=None):
+        """
+        :param collection: the collection name
+        :param query: a mongo query dict
+        :param fetch: called to load the document on a miss
+        :param timeout: seconds to keep the document, None for no expiry
+        :return: the document, or None if there is no match
+        """
+        key = self._key(collection, query)
+        document = self.backend.get(key)
+        if document is not None:
+            self.hits += 1
+            if document == _MISSING:
+                return None
+            return BSON(document).decode()
+        self.misses += 1
+        document = fetch()
+        if document is None:
+            self.backend.set(key, _MISSING, timeout)
+        else:
+            self.backend.set(key, BSON.encode(document), timeout)
+        return document
+
+    def invalidate(self, collection):
+        generation = uuid.uuid4().hex
+        self.backend.set('generation:{}'.format(collection), generation)
+        return generation
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.backend.evictions}
+
+
+_document_cache = None
+
+
+def get_document_cache():
+    """
+    The process wide DocumentCache, configured by MONGO_DOCUMENT_CACHE:
+    {'BACKEND': 'lru' or 'django', 'MAX_SIZE': ..., 'ALIAS': ...}
+    """
+    global _document_cache
+    if _document_cache is None:
+        config = getattr(settings, 'MONGO_DOCUMENT_CACHE', {})
+        if config.get('BACKEND') == 'django':
+            backend = DjangoCacheBackend(config.get('ALIAS', 'default'))
+        else:
+            backend = LRUCache(config.get('MAX_SIZE', DEFAULT_MAX_SIZE))
+        _document_cache = DocumentCache(backend)
+    return _document_cache
+
+
+def set_document_cache(cache):
+    global _document_cache
+    _document_cache = cache
@@ -127,6 +127,9 @@ class MongoRelatedField(MongoField):
 
     @classmethod
     def db_parse(cls, value):
+        if isinstance(value, models.Model):
+            # already resolved by prefetch
+            return value
         pk = value.get('pk')
         app = value.get('app')
         model = value.get('model')
@@ -134,6 +137,24 @@ class MongoRelatedField(MongoField):
                           model_name=model)
         return model.objects.get(pk=pk)
 
+    @classmethod
+    def prefetch(cls, values):
+        """
+        Resolve many stored references with one query per Django model
+        :param values: stored reference dicts
+        :return: a dict mapping (app, model, pk) to model instances
+        """
+        pks = dict()
+        for value in values:
+            key = (value.get('app'), value.get('model'))
+            pks.setdefault(key, set()).add(value.get('pk'))
+        instances = dict()
+        for (app, model_name), model_pks in pks.items():
+            model = get_model(app_label=app, model_name=model_name)
+            for pk, instance in model.objects.in_bulk(model_pks).items():
+                instances[(app, model_name, pk)] = instance
+        return instances
+
 
 class MongoUUIDField(MongoField):
     @classmethod
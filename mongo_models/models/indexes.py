@@ -0,0 +1,198 @@
+import logging
+
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING
+
+from connector.models import MongoConnector
+from mongo_models.models import fields as mongo_fields
+
+log = logging.getLogger(__name__)
+
+# index options compared when diffing against the server
+FLAG_OPTIONS = ('unique', 'sparse')
+VALUE_OPTIONS = ('expireAfterSeconds', 'partialFilterExpression')
+
+
+class Index(object):
+    """
+    An index declared in a model's _indexes list:
+
+        _indexes = [Index('name'),
+                    Index('owner', '-created', unique=True),
+                    Index('created', expire_after_seconds=3600),
+                    Index('state', partial_filter={'state': 'open'})]
+
+    Field names prefixed with '-' are indexed in descending order.
+    """
+
+    def __init__(self, *fields, **kwargs):
+        if not fields:
+            raise ValueError("An index needs at least one field")
+        self.keys = list()
+        for field in fields:
+            if field.startswith('-'):
+                self.keys.append((field[1:], DESCENDING))
+            else:
+                self.keys.append((field, ASCENDING))
+        self.options = dict()
+        if kwargs.get('unique'):
+            self.options['unique'] = True
+        if kwargs.get('sparse'):
+            self.options['sparse'] = True
+        if kwargs.get('expire_after_seconds') is not None:
+            self.options['expireAfterSeconds'] = \
+                kwargs['expire_after_seconds']
+        if kwargs.get('partial_filter'):
+            self.options['partialFilterExpression'] = \
+                kwargs['partial_filter']
+        self.name = kwargs.get('name') or '_'.join(
+            '{}_{}'.format(key, direction) for key, direction in self.keys)
+
+    @property
+    def fields(self):
+        return [key for key, direction in self.keys]
+
+    def matches(self, info):
+        """
+        :param info: an entry of Collection.index_information()
+        :return: whether the server index has the same keys and options
+        """
+        keys = [(key, int(direction)) for key, direction in info['key']]
+        if keys != self.keys:
+            return False
+        for option in FLAG_OPTIONS:
+            if bool(info.get(option)) != bool(self.options.get(option)):
+                return False
+        for option in VALUE_OPTIONS:
+            if info.get(option) != self.options.get(option):
+                return False
+        return True
+
+    def __repr__(self):
+        return '(Index {}: {})'.format(self.name, self.options)
+
+
+def get_indexes(model):
+    """
+    The indexes declared by a model, plus the unique index implied by its
+    _unique_on fields.  The implied index only covers documents having
+    every one of those fields, as documents without them were never
+    matched against each other by _unique_on.
+    """
+    indexes = list(getattr(model, '_indexes', None) or [])
+    if model._unique_on:
+        fields = list()
+        for field in model._unique_on:
+            fields.extend(_field_paths(model, field))
+        if fields:
+            implied = Index(*fields, unique=True, partial_filter=dict(
+                (field, {'$exists': True}) for field in fields))
+            if not any(index.keys == implied.keys for index in indexes):
+                indexes.append(implied)
+    return indexes
+
+
+def _field_paths(model, field):
+    _type = model._meta['fields'][field]
+    if isinstance(_type, list):
+        # _build_query skips MongoLists
+        return []
+    if not isinstance(_type, mongo_fields.MongoField):
+        # _build_query matches embedded models on all of their fields
+        paths = list()
+        for sub in _type._meta['fields']:
+            if sub != '_id':
+                paths.extend('{}.{}'.format(field, path) for path in
+                             _field_paths(_type.__class__, sub))
+        return paths
+    return [field]
+
+
+def ensure_indexes(model, background=True, drop=False, dry_run=False):
+    """
+    Create the declared indexes of a model that are missing on the server.
+    Indexes whose options changed, and with drop=True indexes that are no
+    longer declared, are dropped first.
+    :param model: a MongoModel class
+    :param background: build new indexes in the background
+    :param drop: drop indexes that are no longer declared
+    :param dry_run: only report what would change
+    :return: a tuple of (created, dropped) index names
+    """
+    table = MongoConnector.get_table(model)
+    existing = table.index_information()
+    created = list()
+    dropped = list()
+    declared = dict()
+    for index in get_indexes(model):
+        declared[index.name] = index
+        info = existing.get(index.name)
+        if info is not None and index.matches(info):
+            continue
+        if info is not None:
+            log.info('Index {} on {} changed, rebuilding'.
+                     format(index.name, table.name))
+            if not dry_run:
+                table.drop_index(index.name)
+            dropped.append(index.name)
+        if not dry_run:
+            options = dict(index.options)
+            options['background'] = background
+            table.create_index(index.keys, name=index.name, **options)
+        created.append(index.name)
+    if drop:
+        for name in existing:
+            if name != '_id_' and name not in declared:
+                if not dry_run:
+                    table.drop_index(name)
+                dropped.append(name)
+    return created, dropped
+
+
+def query_fields(query):
+    """
+    The field names a query filters on, including those inside $and/$or
+    """
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for sub_query in value:
+                fields.update(query_fields(sub_query))
+        elif not key.startswith('$'):
+            fields.add(key)
+    return fields
+
+
+def is_covered(model, query):
+    """
+    :return: whether some declared index (or _id) can serve the query,
+        i.e. its first field is filtered on
+    """
+    fields = query_fields(query)
+    if not fields or '_id' in fields:
+        return True
+    for index in get_indexes(model):
+        if index.fields[0] in fields:
+            return True
+    return False
+
+
+_reported = set()
+
+
+def check_query(model, query):
+    """
+    Log a warning the first time a query filtering on a set of fields is
+    not covered by any index declared on the model.  Enabled by the
+    MONGO_WARN_UNINDEXED setting, which defaults to DEBUG.
+    """
+    if not getattr(settings, 'MONGO_WARN_UNINDEXED', settings.DEBUG):
+        return
+    shape = (model, frozenset(query_fields(query)))
+    if shape in _reported:
+        return
+    _reported.add(shape)
+    if not is_covered(model, query):
+        log.warning('Query on {} filtering on {} is not covered by any '
+                    'declared index'.format(MongoConnector.get_table_name(
+                        model), sorted(shape[1])))
@@ -0,0 +1,569 @@
+from itertools import islice
+
+from bson import json_util
+from bson.son import SON
+from django.core import signing
+from pymongo import ASCENDING, DESCENDING
+
+from connector.instrumentation import instrument
+from connector.models import MongoConnector
+from mongo_models.models import aggregation, fields as mongo_fields
+from mongo_models.models.aio import AsyncCursor, submit
+from mongo_models.models.indexes import check_query
+
+
+def _get_value(document, parts, parse):
+    value = document
+    for part in parts:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    if value is not None and parse is not None:
+        return parse(value)
+    return value
+
+
+class _TokenSerializer(object):
+    """
+    signing serializer for page tokens, which hold BSON values such as
+    ObjectIds and datetimes
+    """
+
+    def dumps(self, obj):
+        return json_util.dumps(obj, separators=(',', ':')).encode('latin-1')
+
+    def loads(self, data):
+        return json_util.loads(data.decode('latin-1'))
+
+
+_TOKEN_SALT = 'mongo_models.page'
+
+
+def _after(keys, values):
+    """
+    The range predicate selecting the documents sorted after the given
+    values of the sort keys
+    """
+    clauses = list()
+    for index, (key, direction) in enumerate(keys):
+        clause = dict((previous, value) for (previous, _), value in
+                      zip(keys[:index], values))
+        clause[key] = {'$gt' if direction == ASCENDING else '$lt':
+                       values[index]}
+        clauses.append(clause)
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
+
+
+class Page(object):
+    """
+    A page of models from QuerySet.paginate.  next_token is the opaque
+    token of the following page, None on the last page.
+    """
+
+    def __init__(self, items, next_token):
+        self.items = items
+        self.next_token = next_token
+
+    @property
+    def has_next(self):
+        return self.next_token is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page of {} items, next {}>'.format(len(self.items),
+                                                  self.next_token)
+
+
+class QuerySet(object):
+    """
+    Lazy, chainable query over the collection of a MongoModel.  Nothing is
+    sent to the server until the QuerySet is iterated, and documents are
+    hydrated one batch at a time so memory stays flat however large the
+    result set is.
+    """
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_PAGE_SIZE = 100
+
+    def __init__(self, model, query=None):
+        self.model = model
+        self._query = dict(query or {})
+        self._sort = list()
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = self.DEFAULT_BATCH_SIZE
+        self._prefetch_related = tuple()
+        self._only = None
+        self._defer = frozenset()
+        self._decode_on_access = None
+
+    def _clone(self):
+        clone = self.__class__(self.model, self._query)
+        clone._sort = list(self._sort)
+        clone._skip = self._skip
+        clone._limit = self._limit
+        clone._batch_size = self._batch_size
+        clone._prefetch_related = self._prefetch_related
+        clone._only = self._only
+        clone._defer = self._defer
+        clone._decode_on_access = self._decode_on_access
+        return clone
+
+    def filter(self, query=None, **kwargs):
+        """
+        Narrow the query; conflicting keys are combined with $and
+        :param query: a mongo query dict
+        :param kwargs: field=value equality conditions
+        :return: a new QuerySet
+        """
+        conditions = dict(query or {})
+        conditions.update(kwargs)
+        clone = self._clone()
+        if set(conditions) & set(clone._query):
+            clone._query = {'$and': [clone._query, conditions]}
+        else:
+            clone._query.update(conditions)
+        return clone
+
+    def order_by(self, *keys):
+        """
+        :param keys: field names, prefixed with '-' for descending order
+        :return: a new QuerySet
+        """
+        clone = self._clone()
+        clone._sort = list()
+        for key in keys:
+            if key.startswith('-'):
+                clone._sort.append((key[1:], DESCENDING))
+            else:
+                clone._sort.append((key, ASCENDING))
+        return clone
+
+    def limit(self, count):
+        clone = self._clone()
+        clone._limit = count
+        return clone
+
+    def batch_size(self, size):
+        if size < 1:
+            raise ValueError("Batch size must be positive: {}".format(size))
+        clone = self._clone()
+        clone._batch_size = size
+        return clone
+
+    def only(self, *fields):
+        """
+        Load only the given fields; the others are fetched in one round trip
+        the first time any of them is accessed
+        :param fields: field names
+        :return: a new QuerySet
+        """
+        self._check_fields(fields)
+        clone = self._clone()
+        clone._only = frozenset(fields) | frozenset(['_id'])
+        return clone
+
+    def defer(self, *fields):
+        """
+        Leave the given fields out of the loaded documents; they are fetched
+        in one round trip the first time any of them is accessed
+        :param fields: field names
+        :return: a new QuerySet
+        """
+        self._check_fields(fields)
+        if '_id' in fields:
+            raise ValueError("_id cannot be deferred")
+        clone = self._clone()
+        clone._defer = self._defer | frozenset(fields)
+        return clone
+
+    def decode_on_access(self, enabled=True):
+        """
+        Keep each loaded document as returned by the driver and decode a
+        field only the first time it is read; fields never read are saved
+        back as stored.  Defaults to the model's _decode_on_access.  Models
+        loaded with prefetch_related are always decoded up front.
+        :return: a new QuerySet
+        """
+        clone = self._clone()
+        clone._decode_on_access = enabled
+        return clone
+
+    def _check_fields(self, fields):
+        for field in fields:
+            if field not in self.model._meta['fields']:
+                raise ValueError("{} is not a field of {}".
+                                 format(field, self.model.__name__))
+
+    def _deferred_fields(self):
+        fields = frozenset(self.model._meta['fields'])
+        if self._only is not None:
+            return (fields - self._only) | self._defer
+        return self._defer
+
+    def _projection(self):
+        if self._only is not None:
+            return dict((field, 1) for field in self._only - self._defer)
+        if self._defer:
+            return dict((field, 0) for field in self._defer)
+        return None
+
+    def prefetch_related(self, *fields):
+        """
+        Resolve the Django objects referenced by MongoRelatedFields with one
+        query per Django model for each batch, instead of one per document
+        :param fields: related field names, dotted for embedded models
+        :return: a new QuerySet
+        """
+        for field in fields:
+            self._check_related_field(field)
+        clone = self._clone()
+        clone._prefetch_related = self._prefetch_related + fields
+        return clone
+
+    def _check_related_field(self, path):
+        model = self.model
+        parts = path.split('.')
+        for part in parts[:-1]:
+            _type = model._meta['fields'].get(part)
+            if _type is None or isinstance(_type, mongo_fields.MongoField) \
+                    or isinstance(_type, list):
+                raise ValueError("{} is not an embedded model of {}".
+                                 format(part, model.__name__))
+            model = _type.__class__
+        _type = model._meta['fields'].get(parts[-1])
+        if not isinstance(_type, mongo_fields.MongoRelatedField):
+            raise ValueError("{} is not a related field of {}".
+                             format(path, self.model.__name__))
+
+    @staticmethod
+    def _prefetch(documents, path):
+        parts = path.split('.')
+        field = parts[-1]
+        containers = list()
+        for document in documents:
+            container = document
+            for part in parts[:-1]:
+                container = container.get(part)
+                if not isinstance(container, dict):
+                    break
+            else:
+                if isinstance(container.get(field), dict):
+                    containers.append(container)
+        instances = mongo_fields.MongoRelatedField.prefetch(
+            container[field] for container in containers)
+        for container in containers:
+            value = container[field]
+            instance = instances.get((value.get('app'), value.get('model'),
+                                      value.get('pk')))
+            if instance is not None:
+                container[field] = instance
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Slicing with a step is not supported")
+            start = key.start or 0
+            if start < 0 or (key.stop is not None and key.stop < 0):
+                raise ValueError("Negative indexing is not supported")
+            clone = self._clone()
+            clone._skip = self._skip + start
+            if key.stop is not None:
+                stop = max(key.stop - start, 0)
+                if self._limit:
+                    stop = min(stop, max(self._limit - start, 0))
+                if not stop:
+                    # limit(0) means no limit, so an empty slice has to
+                    # be expressed some other way
+                    clone._query = {'$and': [clone._query,
+                                             {'_id': {'$in': []}}]}
+                clone._limit = stop
+            elif self._limit:
+                clone._limit = max(self._limit - start, 0)
+            return clone
+        if key < 0:
+            raise ValueError("Negative indexing is not supported")
+        if self._limit and key >= self._limit:
+            raise IndexError("QuerySet index out of range")
+        for model in self[key:key + 1]:
+            return model
+        raise IndexError("QuerySet index out of range")
+
+    def _cursor(self, projection=None):
+        check_query(self.model, self._query)
+        table = MongoConnector.get_table(self.model)
+        cursor = table.find(self._query, projection or self._projection())
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._skip:
+            cursor = cursor.skip(self._skip)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        return cursor.batch_size(self._batch_size)
+
+    def _hydrate(self, documents, deferred=None):
+        for path in self._prefetch_related:
+            self._prefetch(documents, path)
+        if deferred is None:
+            deferred = self._deferred_fields()
+        decode_on_access = self._decode_on_access
+        if self._prefetch_related:
+            decode_on_access = False
+        return [self.model._from_document(document, deferred,
+                                          decode_on_access)
+                for document in documents]
+
+    def iterator(self):
+        """
+        Stream models from the server, hydrating one batch at a time
+        """
+        with instrument(self.model, 'find', self._query,
+                        streaming=True) as operation:
+            with operation.server():
+                documents = iter(self._cursor())
+            while True:
+                with operation.server():
+                    batch = list(islice(documents, self._batch_size))
+                if not batch:
+                    break
+                operation.add_documents(batch)
+                with operation.processing():
+                    models = self._hydrate(batch)
+                for model in models:
+                    yield model
+
+    def __iter__(self):
+        return self.iterator()
+
+    def values(self, *fields):
+        """
+        Stream plain dicts of the given fields straight from the cursor,
+        without building models.  Values are typed by the fields' db_parse,
+        but embedded models and lists are left as stored and related fields
+        as their stored references.
+        :param fields: field names, dotted for values of embedded models;
+            every field of the model by default
+        :return: a generator of dicts
+        """
+        fields = self._value_fields(fields)
+        return (dict(zip(fields, row)) for row in self._rows(fields))
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Like values(), but streams tuples in the order of the given fields
+        :param flat: stream the values themselves when a single field is
+            given
+        :return: a generator of tuples, or of values if flat is set
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments to values_list: "
+                            "{}".format(sorted(kwargs)))
+        if flat and len(fields) != 1:
+            raise ValueError("flat is only valid with a single field")
+        fields = self._value_fields(fields)
+        if flat:
+            return (row[0] for row in self._rows(fields))
+        return (tuple(row) for row in self._rows(fields))
+
+    def _value_fields(self, fields):
+        if not fields:
+            return [field for field, decode in self.model._meta['decoders']]
+        for field in fields:
+            if field.split('.', 1)[0] not in self.model._meta['fields']:
+                raise ValueError("{} is not a field of {}".
+                                 format(field, self.model.__name__))
+        return list(fields)
+
+    def _rows(self, fields):
+        projection = dict((field, 1) for field in fields)
+        if '_id' not in projection:
+            projection['_id'] = 0
+        parsers = self.model._meta['parsers']
+        getters = [(field.split('.'), parsers.get(field)) for field in fields]
+        with instrument(self.model, 'values', self._query,
+                        streaming=True) as operation:
+            with operation.server():
+                documents = iter(self._cursor(projection))
+            while True:
+                with operation.server():
+                    batch = list(islice(documents, self._batch_size))
+                if not batch:
+                    break
+                operation.add_documents(batch)
+                with operation.processing():
+                    rows = [[_get_value(document, parts, parse)
+                             for parts, parse in getters]
+                            for document in batch]
+                for row in rows:
+                    yield row
+
+    def _page_keys(self):
+        """
+        The sort keys of the pages: the QuerySet's order, ending with _id so
+        that every document has a distinct position
+        """
+        keys = list(self._sort) or [('_id', ASCENDING)]
+        if '_id' not in [key for key, direction in keys]:
+            keys.append(('_id', ASCENDING))
+        return keys
+
+    def _encode_token(self, keys, document):
+        values = [_get_value(document, key.split('.'), None)
+                  for key, direction in keys]
+        return signing.dumps({'k': keys, 'v': values}, salt=_TOKEN_SALT,
+                             serializer=_TokenSerializer, compress=True)
+
+    def _decode_token(self, keys, token):
+        try:
+            state = signing.loads(token, salt=_TOKEN_SALT,
+                                  serializer=_TokenSerializer)
+        except signing.BadSignature:
+            raise ValueError("Invalid page token: {}".format(token))
+        if [tuple(key) for key in state['k']] != keys:
+            raise ValueError("The page token was made for a different order: "
+                             "{}".format(state['k']))
+        return state['v']
+
+    def paginate(self, page_size=DEFAULT_PAGE_SIZE, after=None):
+        """
+        Fetch one page by range on the sort keys (keyset pagination), so
+        every page costs the same however deep it is.  The order is the
+        one given by order_by, _id by default, with _id breaking ties; it
+        should be covered by an index, and the sort keys present in every
+        document.
+        :param page_size: the number of models per page
+        :param after: the next_token of the previous page, None for the
+            first page
+        :return: a Page
+        """
+        if page_size < 1:
+            raise ValueError("Page size must be positive: {}".
+                             format(page_size))
+        if self._skip or self._limit:
+            raise ValueError("Pagination cannot be combined with slicing "
+                             "or limit")
+        keys = self._page_keys()
+        query = self._query
+        if after is not None:
+            condition = _after(keys, self._decode_token(keys, after))
+            query = {'$and': [query, condition]} if query else condition
+        # the token is read off the sort keys, so they are always loaded
+        projection = self._projection()
+        loaded = set()
+        if projection and any(projection.values()):
+            projection.update((key, 1) for key, direction in keys)
+            loaded.update(key for key, direction in keys if '.' not in key)
+        elif projection:
+            for key, direction in keys:
+                field = key.split('.', 1)[0]
+                if projection.pop(field, None) is not None:
+                    loaded.add(field)
+                projection.pop(key, None)
+            projection = projection or None
+        check_query(self.model, query)
+        table = MongoConnector.get_table(self.model)
+        with instrument(self.model, 'paginate', query) as operation:
+            with operation.server():
+                documents = list(table.find(query, projection).sort(keys).
+                                 limit(page_size + 1))
+            next_token = None
+            if len(documents) > page_size:
+                documents = documents[:page_size]
+                next_token = self._encode_token(keys, documents[-1])
+            operation.add_documents(documents)
+            with operation.processing():
+                return Page(self._hydrate(
+                    documents, self._deferred_fields() - loaded), next_token)
+
+    def scan(self, page_size=DEFAULT_PAGE_SIZE, after=None):
+        """
+        Walk every matching document one page at a time.  Each page is its
+        own range query, so no server cursor is held open between pages,
+        and a job saving the next_token of each page it completes can
+        resume with after after a crash.
+        :return: a generator of Pages
+        """
+        while True:
+            page = self.paginate(page_size, after)
+            if page.items:
+                yield page
+            if not page.has_next:
+                break
+            after = page.next_token
+
+    def aiterator(self):
+        """
+        :return: an AsyncCursor streaming the models without blocking
+        """
+        return AsyncCursor(self)
+
+    def aggregate(self, pipeline, allow_disk_use=False, hydrate=False):
+        """
+        Run an aggregation pipeline over the documents of this QuerySet: its
+        query, order, skip and limit become the leading stages
+        :param pipeline: a list of stages
+        :return: a generator of the resulting documents or models
+        """
+        stages = list()
+        if self._query:
+            stages.append(aggregation.match(self._query))
+        if self._sort:
+            stages.append({'$sort': SON(self._sort)})
+        if self._skip:
+            stages.append(aggregation.skip(self._skip))
+        if self._limit:
+            stages.append(aggregation.limit(self._limit))
+        if isinstance(pipeline, dict):
+            pipeline = [pipeline]
+        return aggregation.aggregate(self.model, stages + list(pipeline),
+                                     self._batch_size, allow_disk_use,
+                                     hydrate)
+
+    def count(self):
+        with instrument(self.model, 'count', self._query) as operation:
+            with operation.server():
+                return self._cursor().count(with_limit_and_skip=True)
+
+    def exists(self):
+        with instrument(self.model, 'exists', self._query) as operation:
+            with operation.server():
+                return self._cursor().limit(1).\
+                    count(with_limit_and_skip=True) > 0
+
+    def __nonzero__(self):
+        return self.exists()
+
+    __bool__ = __nonzero__
+
+    def get(self):
+        """
+        :return: the only model matching the query, or None
+        """
+        models = list(self.limit(2))
+        if len(models) > 1:
+            raise ValueError("Multiple results returned for query {}".
+                             format(self._query))
+        elif models:
+            return models[0]
+        return None
+
+    def acount(self):
+        return submit(self.count)
+
+    def aget(self):
+        return submit(self.get)
+
+    def first(self):
+        for model in self[:1]:
+            return model
+        return None
+
+    def __repr__(self):
+        return '<QuerySet {}: {}>'.format(self.model.__name__, self._query)
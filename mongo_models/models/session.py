@@ -0,0 +1,95 @@
+import threading
+
+from connector.models import MongoConnector
+
+_local = threading.local()
+
+
+def get_session():
+    """
+    :return: the innermost active Session of this thread, or None
+    """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions:
+        return sessions[-1]
+    return None
+
+
+class Session(object):
+    """
+    Request-scoped unit of work.  While a session is active, each document
+    is hydrated into a single model instance per (collection, _id), repeat
+    lookups by _id are answered from that identity map, and commit() saves
+    every new and dirty model with one bulk write per model class.
+
+        with Session():
+            model = Model.get_by_id(pk)
+            model.name = 'changed'
+        # the change is saved when the block exits without an error
+    """
+
+    def __init__(self):
+        self.identity_map = dict()
+        self.new = list()
+
+    @staticmethod
+    def _key(klass, _id):
+        return MongoConnector.get_table_name(klass), _id
+
+    def begin(self):
+        if getattr(_local, 'sessions', None) is None:
+            _local.sessions = list()
+        _local.sessions.append(self)
+        return self
+
+    def close(self):
+        sessions = getattr(_local, 'sessions', None)
+        if sessions and self in sessions:
+            sessions.remove(self)
+        self.clear()
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+
+    def get(self, klass, _id):
+        return self.identity_map.get(self._key(klass, _id))
+
+    def add(self, model):
+        """
+        Track a model so it is saved on commit
+        """
+        if model._id is None:
+            if model not in self.new:
+                self.new.append(model)
+        else:
+            self.identity_map[self._key(model.__class__, model._id)] = model
+
+    def discard(self, model):
+        if model in self.new:
+            self.new.remove(model)
+        if model._id is not None:
+            self.identity_map.pop(self._key(model.__class__, model._id),
+                                  None)
+
+    def commit(self):
+        models = dict()
+        for model in self.new + list(self.identity_map.values()):
+            models.setdefault(model.__class__, list()).append(model)
+        for klass, instances in models.items():
+            klass.save_many(instances)
+        for model in self.new:
+            if model._id is not None:
+                self.identity_map[self._key(model.__class__,
+                                            model._id)] = model
+        self.new = [model for model in self.new if model._id is None]
+
+    def clear(self):
+        self.identity_map.clear()
+        self.new = list()
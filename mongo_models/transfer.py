@@ -0,0 +1,330 @@
+import gzip
+import io
+import os
+import struct
+from itertools import islice
+
+from bson import BSON, json_util
+from pymongo import ASCENDING
+
+from connector.instrumentation import instrument
+from connector.models import MongoConnector
+from mongo_models.models import fields as mongo_fields
+
+FORMATS = ('jsonl', 'bson')
+DEFAULT_BATCH_SIZE = 1000
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def _format(path, format=None):
+    """
+    The file format, given or guessed from the extension of path, ignoring
+    a trailing .gz
+    """
+    if format is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        format = os.path.splitext(name)[1][1:]
+        if format == 'json':
+            format = 'jsonl'
+    if format not in FORMATS:
+        raise ValueError("Unknown format {} for {}, expected one of {}".
+                         format(format, path, ', '.join(FORMATS)))
+    return format
+
+
+def _compressed(path, compress=None):
+    if compress is None:
+        return path.endswith('.gz')
+    return compress
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+
+def _write_checkpoint(path, state):
+    # written aside and renamed, so a crash never leaves a partial one
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write(json_util.dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, path)
+
+
+def _encode(document, format):
+    if format == 'bson':
+        return BSON.encode(document)
+    return (json_util.dumps(document) + '\n').encode('utf-8')
+
+
+def _gzip(data):
+    """
+    Compress data as a complete gzip member; files made of several members
+    read back as one stream
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _take_references(model, document):
+    """
+    Take the stored references of related fields, embedded models' included,
+    out of a copy of document, so the round trip does not resolve them
+    :return: the copy and the references, keyed by field and list index
+    """
+    document = dict(document)
+    references = dict()
+    for field, _type in model._meta['fields'].items():
+        value = document.get(field)
+        if value is None:
+            continue
+        if isinstance(_type, mongo_fields.MongoRelatedField):
+            if not isinstance(value, dict):
+                raise ValueError("Invalid value: {} for type {}".format(
+                    value, _type.__class__.__name__))
+            references[field] = document.pop(field)
+        elif isinstance(_type, list):
+            data_type = model._meta['fields_meta'][field]['data_type']
+            if not hasattr(data_type, '_meta') or \
+                    not isinstance(value, list):
+                continue
+            items = dict()
+            value = list(value)
+            for index, item in enumerate(value):
+                if isinstance(item, dict):
+                    value[index], item_references = \
+                        _take_references(data_type, item)
+                    if item_references:
+                        items[index] = item_references
+            document[field] = value
+            if items:
+                references[field] = items
+        elif not isinstance(_type, mongo_fields.MongoField) and \
+                isinstance(value, dict):
+            document[field], embedded = \
+                _take_references(_type.__class__, value)
+            if embedded:
+                references[field] = embedded
+    return document, references
+
+
+def _put_references(model, values, references):
+    for field, reference in references.items():
+        _type = model._meta['fields'][field]
+        if isinstance(_type, mongo_fields.MongoRelatedField):
+            values[field] = reference
+        elif isinstance(_type, list):
+            data_type = model._meta['fields_meta'][field]['data_type']
+            items = values[field]
+            for index, item_references in reference.items():
+                if items[index] is None:
+                    items[index] = dict()
+                _put_references(data_type, items[index], item_references)
+        else:
+            _put_references(_type.__class__, values.setdefault(field, {}),
+                            reference)
+
+
+def _serialize(model, document):
+    """
+    Round trip a document through the model, validating its fields and
+    dropping the keys the model does not declare.  Related fields keep
+    their stored references instead of being resolved through Django.
+    :return: the serialized document, or None when it has none of the
+        model's fields
+    """
+    document, references = _take_references(model, document)
+    values = model()._set_values(document, set_original=True).\
+        _get_values() or dict()
+    _put_references(model, values, references)
+    return values or None
+
+
+def export_documents(model, path, query=None, format=None, compress=None,
+                     raw=False, batch_size=DEFAULT_BATCH_SIZE, resume=False):
+    """
+    Stream the documents of a model's collection to a JSONL (MongoDB
+    extended JSON, one document per line) or BSON (as written by
+    mongodump) file, one batch at a time and in _id order.  A checkpoint
+    is kept next to the file after every batch and removed once the export
+    completes; an interrupted export continues where it stopped when run
+    again with resume.
+    :param model: the MongoModel class
+    :param path: the file to write
+    :param query: only export the documents matching this query
+    :param format: 'jsonl' or 'bson', guessed from the extension of path
+        by default
+    :param compress: gzip the file; by default when path ends with .gz
+    :param raw: write the documents as stored instead of serializing them
+        through the model
+    :param batch_size: the number of documents per batch and checkpoint
+    :param resume: continue from the checkpoint of an interrupted export
+    :return: the number of documents exported
+    """
+    format = _format(path, format)
+    compress = _compressed(path, compress)
+    checkpoint = path + CHECKPOINT_SUFFIX
+    state = _read_checkpoint(checkpoint) if resume else None
+    query = dict(query or {})
+    if state is not None:
+        after = {'_id': {'$gt': state['last_id']}}
+        query = {'$and': [query, after]} if query else after
+        mode = 'r+b'
+    else:
+        state = {'offset': 0, 'documents': 0, 'last_id': None}
+        mode = 'wb'
+    table = MongoConnector.get_table(model)
+    with open(path, mode) as f, \
+            instrument(model, 'export', query, streaming=True) as operation:
+        # drop whatever was written after the last checkpoint
+        f.seek(state['offset'])
+        f.truncate()
+        with operation.server():
+            documents = iter(table.find(query).sort('_id', ASCENDING).
+                             batch_size(batch_size))
+        while True:
+            with operation.server():
+                batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            operation.add_documents(batch)
+            with operation.processing():
+                if not raw:
+                    batch = [_serialize(model, document)
+                             for document in batch]
+                data = b''.join(_encode(document, format)
+                                for document in batch)
+                if compress:
+                    data = _gzip(data)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            state = {'offset': f.tell(),
+                     'documents': state['documents'] + len(batch),
+                     'last_id': batch[-1]['_id']}
+            _write_checkpoint(checkpoint, state)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state['documents']
+
+
+def _read_bson(stream):
+    while True:
+        header = stream.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated BSON document")
+        size = struct.unpack('<i', header)[0]
+        data = header + stream.read(size - 4)
+        if len(data) < size:
+            raise ValueError("Truncated BSON document")
+        yield data
+
+
+def _read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _records(stream, format):
+    """
+    The undecoded documents of a stream, so skipping them is cheap
+    """
+    if format == 'bson':
+        return _read_bson(stream)
+    return _read_jsonl(stream)
+
+
+def _decode(record, format):
+    if format == 'bson':
+        return BSON(record).decode()
+    return json_util.loads(record.decode('utf-8'))
+
+
+def _load_batch(model, table, documents, ordered):
+    if ordered:
+        bulk = table.initialize_ordered_bulk_op()
+    else:
+        bulk = table.initialize_unordered_bulk_op()
+    for document in documents:
+        if '_id' in document:
+            bulk.find({'_id': document['_id']}).upsert().\
+                replace_one(document)
+        else:
+            bulk.insert(document)
+    try:
+        bulk.execute()
+    finally:
+        model._invalidate_cache()
+
+
+def import_documents(model, path, format=None, compress=None, raw=False,
+                     batch_size=DEFAULT_BATCH_SIZE, resume=False,
+                     ordered=False):
+    """
+    Stream a file written by export_documents (or mongoexport/mongodump)
+    into a model's collection with chunked bulk writes.  Documents with
+    an _id replace the stored document with that _id, so importing the
+    same file twice is harmless.  Documents with none of the model's
+    fields are skipped unless raw is set.  A checkpoint is kept next to
+    the file after every batch and removed once the import completes; an
+    interrupted import continues where it stopped when run again with
+    resume.
+    :param model: the MongoModel class
+    :param path: the file to read
+    :param format: 'jsonl' or 'bson', guessed from the extension of path
+        by default
+    :param compress: whether the file is gzipped; by default when path
+        ends with .gz
+    :param raw: write the documents as read instead of validating them
+        through the model
+    :param batch_size: the number of documents per bulk write and
+        checkpoint
+    :param resume: continue from the checkpoint of an interrupted import
+    :param ordered: stop at the first failing write of a batch
+    :return: the number of documents imported
+    """
+    format = _format(path, format)
+    compress = _compressed(path, compress)
+    checkpoint = path + CHECKPOINT_SUFFIX
+    state = _read_checkpoint(checkpoint) if resume else None
+    if state is None:
+        state = {'documents': 0, 'skipped': 0}
+    table = MongoConnector.get_table(model)
+    with open(path, 'rb') as f, \
+            instrument(model, 'import', streaming=True) as operation:
+        stream = gzip.GzipFile(fileobj=f, mode='rb') if compress else f
+        records = _records(stream, format)
+        for record in islice(records, state['documents']):
+            pass
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            with operation.processing():
+                documents = [_decode(record, format) for record in batch]
+                if not raw:
+                    documents = [_serialize(model, document)
+                                 for document in documents]
+                    documents = [document for document in documents
+                                 if document is not None]
+            if documents:
+                operation.add_documents(documents)
+                with operation.server():
+                    _load_batch(model, table, documents, ordered)
+            state = {'documents': state['documents'] + len(batch),
+                     'skipped': state.get('skipped', 0) +
+                     len(batch) - len(documents)}
+            _write_checkpoint(checkpoint, state)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state['documents'] - state.get('skipped', 0)